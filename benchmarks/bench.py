@@ -0,0 +1,183 @@
+'''
+Benchmarks for the parsing, caching and netlist editing hot paths of pyltspice
+
+Runs without LTspice: synthetic .raw/.log/.net files are generated with the same helpers as the tests
+(tests/spicefiles.py), and a stub script that copies canned output files stands in for the ltspice executable.
+
+python benchmarks/bench.py [--points 1000000] [--vars 20] [--complex] [--encoding utf8] [--folder-size 2000]
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'tests'))
+import pyltspice
+from spicefiles import write_raw, write_log, write_stub
+
+
+### Synthetic files
+def bench_raw(filepath, numpoints, numvars, complex=False, encoding='utf_16_le'):
+    ''' Write a transient (or AC, if complex) .raw file with numvars columns including the axis '''
+    axis = np.linspace(0, 1e-2, numpoints)
+    cols = {'frequency': axis.astype(np.complex128)} if complex else {'time': axis}
+    for i in range(1, numvars):
+        cols[f'V(n{i:03d})'] = np.sin(axis * 1e3 * i)
+    if complex:
+        write_raw(filepath, cols, flags='complex forward log', plotname='AC Analysis', encoding=encoding)
+    else:
+        write_raw(filepath, cols, encoding=encoding)
+
+def make_netlist(numlines, numparams=20):
+    ''' Netlist with a chain of resistors and some .PARAMs '''
+    netlist = ['* benchmark netlist', 'V1 n0 0 PULSE(0 5 1m 1n 1n 10m)']
+    netlist += [f'R{i} n{i} n{i + 1} {{R}}' for i in range(1, numlines)]
+    netlist += [f'.PARAM P{i}=1' for i in range(numparams)]
+    netlist += ['.PARAM R=1', '.tran 0 10m 0', '.backanno', '.end']
+    return netlist
+
+def write_net(filepath, netlist, encoding='utf_8'):
+    with open(filepath, 'wb') as f:
+        f.write('\n'.join(netlist).encode(encoding))
+
+### Measurement
+def measure(func, repeat=3):
+    ''' Run func repeat times, return (best time, peak traced memory of the first run) '''
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times), peak
+
+def report(name, seconds, peak, amount=None, unit=None):
+    rate = f'{amount / seconds:12.1f} {unit}/s' if amount is not None else ''
+    print(f'{name:<40} {seconds * 1e3:10.2f} ms {peak / 2**20:10.1f} MB peak {rate}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--points', type=int, default=200_000, help='points in the .raw file')
+    parser.add_argument('--vars', type=int, default=20, help='variables in the .raw file, including the axis')
+    parser.add_argument('--complex', action='store_true', help='complex (AC analysis) data')
+    parser.add_argument('--encoding', choices=['utf16', 'utf8'], default='utf16', help='encoding of the headers')
+    parser.add_argument('--folder-size', type=int, default=1000, help='simulations in the cache folder')
+    parser.add_argument('--netlist-lines', type=int, default=5000, help='lines in the netlist for editing')
+    parser.add_argument('--variants', type=int, default=200, help='netlist variants for the sweep benchmarks')
+    parser.add_argument('--runs', type=int, default=20, help='runspice calls through the stub executable')
+    parser.add_argument('--repeat', type=int, default=3, help='timed repetitions of each benchmark')
+    args = parser.parse_args(argv)
+    encoding = {'utf16': 'utf_16_le', 'utf8': 'utf_8'}[args.encoding]
+    pyltspice.verbose = False
+    repeat = args.repeat
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rawpath = os.path.join(tmp, 'bench.raw')
+        logpath = os.path.join(tmp, 'bench.log')
+        netpath = os.path.join(tmp, 'bench.net')
+        bench_raw(rawpath, args.points, args.vars, args.complex, encoding)
+        write_log(logpath, encoding=encoding)
+        netlist = make_netlist(args.netlist_lines)
+        write_net(netpath, netlist)
+        rawmb = os.path.getsize(rawpath) / 2**20
+        column = 'V(n001)'
+        print(f'{args.points} points x {args.vars} variables, {"complex" if args.complex else "real"}, '
+              f'{args.encoding} header: {rawmb:.1f} MB .raw file\n')
+
+        print('Parsing')
+        t, peak = measure(lambda: pyltspice.read_raw(rawpath), repeat)
+        report('read_raw', t, peak, rawmb, 'MB')
+        t, peak = measure(lambda: pyltspice.read_raw(rawpath, columns=[column]), repeat)
+        report('read_raw one column', t, peak, rawmb, 'MB')
+        t, peak = measure(lambda: np.sum(pyltspice.read_raw(rawpath, lazy=True)[column]), repeat)
+        report('read_raw lazy, sum one column', t, peak, rawmb, 'MB')
+        t, peak = measure(lambda: [np.max(c[column]) for c in pyltspice.iter_raw(rawpath, [column], 50_000)], repeat)
+        report('iter_raw max of one column', t, peak, rawmb, 'MB')
+        fastpath = pyltspice.raw_to_fastaccess(rawpath, os.path.join(tmp, 'fast.raw'))
+        t, peak = measure(lambda: pyltspice.read_raw(fastpath, columns=[column]), repeat)
+        report('read_raw one column, FastAccess', t, peak, rawmb, 'MB')
+        t, peak = measure(lambda: pyltspice.read_log(logpath), repeat)
+        report('read_log', t, peak, 1, 'files')
+        t, peak = measure(lambda: pyltspice.read_net(netpath), repeat)
+        report(f'read_net ({args.netlist_lines} lines)', t, peak, 1, 'files')
+        t, peak = measure(lambda: pyltspice.read_spice(rawpath), repeat)
+        report('read_spice', t, peak, rawmb, 'MB')
+        times = np.linspace(0, 1, args.points)
+        volts = np.sin(times * 2 * np.pi * 440)
+        wavpath = os.path.join(tmp, 'bench.wav')
+        t, peak = measure(lambda: pyltspice.write_wav(times, volts, wavpath), repeat)
+        report('write_wav (1 s of audio)', t, peak, 44_100, 'samples')
+
+        print('\nNetlist editing')
+        t, peak = measure(lambda: [pyltspice.netchange(netlist, R=i) for i in range(args.variants)], repeat)
+        report(f'netchange x {args.variants}', t, peak, args.variants, 'variants')
+        paramsets = [{f'P{j}': i for j in range(20)} for i in range(args.variants)]
+        t, peak = measure(lambda: [pyltspice.paramchange(netlist, ps) for ps in paramsets], repeat)
+        report(f'paramchange 20 params x {args.variants}', t, peak, args.variants, 'variants')
+        template = pyltspice.NetlistTemplate(netlist, list(paramsets[0]))
+        t, peak = measure(lambda: [template.render(ps) for ps in paramsets], repeat)
+        report(f'NetlistTemplate.render x {args.variants}', t, peak, args.variants, 'variants')
+        t, peak = measure(lambda: template.hashes(paramsets), repeat)
+        report(f'NetlistTemplate.hashes x {args.variants}', t, peak, args.variants, 'variants')
+
+        print('\nCache')
+        simfolder = os.path.join(tmp, 'sims')
+        os.makedirs(simfolder)
+        pyltspice.simfolder = simfolder
+        small_raw = os.path.join(tmp, 'small.raw')
+        bench_raw(small_raw, 1000, 8)
+        smallnet = make_netlist(10)
+        with open(small_raw, 'rb') as f:
+            small_raw_data = f.read()
+        with open(logpath, 'rb') as f:
+            log_data = f.read()
+        for i in range(args.folder_size):
+            base = os.path.join(simfolder, f'sim_{i:06d}')
+            write_net(base + '.net', pyltspice.paramchange(smallnet, R=i))
+            for ext, data in (('.raw', small_raw_data), ('.log', log_data)):
+                with open(base + ext, 'wb') as f:
+                    f.write(data)
+        t0 = time.perf_counter()
+        pyltspice.cache_index(simfolder)
+        t = time.perf_counter() - t0
+        report(f'index {args.folder_size} existing sims', t, 0, args.folder_size, 'sims')
+        lookups = [pyltspice.paramchange(smallnet, R=i) for i in range(0, args.folder_size, 7)]
+        t, peak = measure(lambda: [pyltspice.from_cache(nl) for nl in lookups], repeat)
+        report(f'from_cache memory hit x {len(lookups)}', t, peak, len(lookups), 'runs')
+        # Without the in-memory cache every hit goes through the index and reads the files
+        cache_bytes = pyltspice.result_cache_bytes
+        pyltspice.result_cache_bytes = 0
+        pyltspice.clear_result_cache()
+        t, peak = measure(lambda: [pyltspice.from_cache(nl) for nl in lookups], repeat)
+        report(f'from_cache disk hit x {len(lookups)}', t, peak, len(lookups), 'runs')
+        pyltspice.result_cache_bytes = cache_bytes
+        misses = [pyltspice.paramchange(smallnet, R=-i) for i in range(1, 200)]
+        t, peak = measure(lambda: [pyltspice.from_cache(nl) for nl in misses], repeat)
+        report(f'from_cache miss x {len(misses)}', t, peak, len(misses), 'runs')
+
+        print('\nrunspice through a stub executable')
+        pyltspice.spicepath, _ = write_stub(tmp, canned=(small_raw, logpath))
+        runs = [pyltspice.paramchange(smallnet, R=f'{i}.5') for i in range(args.runs)]
+        t0 = time.perf_counter()
+        for nl in runs:
+            pyltspice.runspice(nl, check_cache=False)
+        t = time.perf_counter() - t0
+        report(f'runspice x {args.runs}', t, 0, args.runs, 'runs')
+        t0 = time.perf_counter()
+        pyltspice.runspice_many(runs, check_cache=False)
+        t = time.perf_counter() - t0
+        report(f'runspice_many x {args.runs}', t, 0, args.runs, 'runs')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,45 +7,178 @@
 #TODO: Spice can use different syntax for the same thing.  e.g. .param name value  .PARAM name=value ..
 #      write a better parser
 
-import subprocess
 import os
+import io
 import re
 import numpy as np
-from collections.abc import Iterable
-from itertools import chain
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping
+from itertools import chain, islice, product
 from datetime import datetime
 import time
 import fnmatch
-from functools import reduce, partial
+from functools import partial
 import hashlib
+import codecs
+import threading
+import contextlib
+import contextvars
+import weakref
 
-# ltspice uses whatever encoding it feels like using, needs to be detected
-# I think it takes cues from what kind of characters you use in the GUI
-import chardet
-
-verbose = True
+verbose = os.environ.get('PYLTSPICE_VERBOSE', '1').lower() not in ('0', 'false', 'no', 'off', '')
 
 def vprint(*args):
     if verbose:
         print(*args)
 
-# Try to find spice executable, should be at least the XVII version
-spicepaths = [os.path.expandvars(r"%userprofile%\AppData\Local\Programs\ADI\LTspice\LTspice.exe"),
+### Events and instrumentation
+# Things that happen are reported as events: emit(event, **fields)
+# Every function in event_hooks is called with (event, fields), e.g. to feed a metrics system.
+# If verbose, events that have a message are also printed
+event_hooks = []
+event_messages = {
+    'simfolder': 'Simulation files will be stored at {path}.  To change, overwrite the simfolder variable',
+    'read': 'Reading {path}',
+    'read_chunks': 'Reading {path} in chunks of {chunk_points} points',
+    'convert': 'Converting {path} to FastAccess layout',
+    'index_folder': 'Indexing existing simulations in {path}',
+    'cache_hit': 'Reading the previous result of a matching simulation from disk',
+    'memory_hit': 'Using the previous result of a matching simulation from memory',
+    'write_netlist': 'Writing {path}',
+    'execute': 'Executing {path}',
+    'sweep': '{cached} of {total} sweep points found in the cache, running {running}',
+    'refine': 'Refining {param}: {count} more points, {done} of {budget} done',
+    'store': 'Stored {count} results in {path}',
+}
+
+def emit(event, **fields):
+    ''' Report an event to the event_hooks, and print its message if verbose '''
+    if verbose and event in event_messages:
+        print(event_messages[event].format(**fields))
+    for hook in event_hooks:
+        hook(event, fields)
+
+# If record_timings, the wall time and bytes of each stage of a run (cache_lookup, netlist_write, subprocess,
+# read_raw, read_log, read_net) are put in the 'timings' and 'bytes' of the runspice output,
+# and added up in stage_counters.  Every stage is also emitted as a 'stage' event if there are event_hooks.
+record_timings = False
+stage_counters = dict()
+_counters_lock = threading.Lock()
+# Where the stages of the run in progress are recorded
+_run_stats = contextvars.ContextVar('run_stats', default=None)
+
+class _Stage:
+    __slots__ = ('name', 'path', 't0')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        nbytes = 0
+        if self.path is not None and os.path.isfile(self.path):
+            nbytes = os.path.getsize(self.path)
+        if record_timings:
+            stats = _run_stats.get()
+            if stats is not None:
+                stats['timings'][self.name] = stats['timings'].get(self.name, 0) + seconds
+                stats['bytes'][self.name] = stats['bytes'].get(self.name, 0) + nbytes
+            with _counters_lock:
+                counter = stage_counters.setdefault(self.name, {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+                counter['calls'] += 1
+                counter['seconds'] += seconds
+                counter['bytes'] += nbytes
+        emit('stage', stage=self.name, seconds=seconds, bytes=nbytes, path=self.path)
+        return False
+
+_no_stage = contextlib.nullcontext()
+
+def stage(name, path=None):
+    '''
+    Context manager that measures a stage of a run.  path is the file that the stage reads or writes.
+    Costs nothing if record_timings is off and there are no event_hooks
+    '''
+    if record_timings or event_hooks:
+        return _Stage(name, path)
+    return _no_stage
+
+@contextlib.contextmanager
+def collecting_stats():
+    ''' Collect the stages of everything inside into a new dict, or yield None if record_timings is off '''
+    if not record_timings:
+        yield None
+        return
+    stats = {'timings': {}, 'bytes': {}}
+    token = _run_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _run_stats.reset(token)
+
+def attach_stats(d, stats):
+    ''' Put the collected stage timings in the output data of a run (or each step of it) '''
+    if stats is not None:
+        for step in (d if isinstance(d, list) else [d]):
+            step['timings'] = dict(stats['timings'])
+            step['bytes'] = dict(stats['bytes'])
+    return d
+
+def reset_stage_counters():
+    with _counters_lock:
+        stage_counters.clear()
+
+# Settings are resolved on first use, so importing pyltspice doesn't touch the file system.
+# Set them on the module (pyltspice.spicepath = ...) or with the environment variables
+# LTSPICE_PATH, PYLTSPICE_SIMFOLDER and PYLTSPICE_VERBOSE
+
+# Where to look for the spice executable if it isn't set, should be at least the XVII version
+spicepaths = [r"%userprofile%\AppData\Local\Programs\ADI\LTspice\LTspice.exe",
               r"C:\Program Files\ADI\LTspice\LTspice.exe",
               r"C:\Program Files\LTC\LTspiceXVII\XVIIx64.exe"]
-spicepath = next((p for p in spicepaths if os.path.isfile(p)), None)
-
-if spicepath is None:
-    Warning('LTspice executable not found!  You can set the spicepath variable manually.')
 
 # Here is where all the simulation files (netlists and results) will be dumped
 # It can get quite large if you don't delete the files afterward
-#simfolder = os.path.abspath('ltspice_sims')
-simfolder = os.path.expandvars(r"%userprofile%\ltspice_sims")
-
-vprint(f'Simulation files will be stored at {simfolder}.  To change, overwrite the simfolder variable')
+default_simfolder = r"%userprofile%\ltspice_sims"
+
+def get_spicepath():
+    ''' The spice executable: pyltspice.spicepath, else $LTSPICE_PATH, else the first of spicepaths that exists '''
+    path = globals().get('spicepath')
+    if path is None:
+        path = os.environ.get('LTSPICE_PATH')
+        if path is None:
+            path = next((p for p in map(os.path.expandvars, spicepaths) if os.path.isfile(p)), None)
+        if path is None:
+            raise FileNotFoundError('LTspice executable not found!  You can set the spicepath variable manually.')
+        globals()['spicepath'] = path
+    return path
+
+def get_simfolder():
+    ''' The folder for simulation files: pyltspice.simfolder, else $PYLTSPICE_SIMFOLDER, else default_simfolder '''
+    folder = globals().get('simfolder')
+    if folder is None:
+        folder = os.path.expandvars(os.environ.get('PYLTSPICE_SIMFOLDER', default_simfolder))
+        globals()['simfolder'] = folder
+        emit('simfolder', path=folder)
+    return folder
+
+def __getattr__(name):
+    # Module attributes that are resolved on first access
+    if name == 'spicepath':
+        try:
+            return get_spicepath()
+        except FileNotFoundError:
+            return None
+    if name == 'simfolder':
+        return get_simfolder()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-net_hashes = dict()
+# runspice_many() calls from_cache() from several threads at once
+_cache_lock = threading.RLock()
 
 # Sample netlist -- list of strings
 netlist = '''
@@ -64,11 +197,63 @@ C1 N002 0 {C}
 
 netlist_path = os.path.join(os.path.split(__file__)[0], 'example.net')
 
+# Encodings that had to be guessed by chardet, remembered by file and by folder
+_file_encodings = dict()
+_folder_encodings = dict()
+
+def detect_encoding(data, filepath=None):
+    '''
+    Figure out the encoding of the bytes read from filepath.  The encoding returned decodes all of data.
+    Cheap checks first, chardet is slow so it is only used if we have no idea from earlier files,
+    and on the beginning of the file first
+    '''
+    def decodes(encoding):
+        try:
+            data.decode(encoding)
+            return True
+        except (UnicodeDecodeError, LookupError):
+            return False
+    guesses = []
+    if data.startswith(codecs.BOM_UTF8):
+        guesses.append('utf_8_sig')
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        guesses.append('utf_16')
+    # utf-16 without BOM, which ltspice likes to write: every other byte of ascii text is a null byte
+    prefix = data[:4096]
+    half = len(prefix) // 2
+    if half:
+        even_nulls = prefix[0::2].count(0)
+        odd_nulls = prefix[1::2].count(0)
+        if odd_nulls > half / 2 > even_nulls:
+            guesses.append('utf_16_le')
+        if even_nulls > half / 2 > odd_nulls:
+            guesses.append('utf_16_be')
+    guesses.append('utf_8')
+    if filepath is not None:
+        filepath = os.path.abspath(filepath)
+        guesses += [_file_encodings.get(filepath), _folder_encodings.get(os.path.dirname(filepath))]
+    for encoding in guesses:
+        if encoding is not None and decodes(encoding):
+            return encoding
+    # ltspice uses whatever encoding it feels like using, needs to be detected
+    # I think it takes cues from what kind of characters you use in the GUI
+    import chardet
+    guesses = [chardet.detect(prefix)['encoding']]
+    if len(data) > len(prefix):
+        guesses.append(chardet.detect(data)['encoding'])
+    # latin_1 decodes anything
+    guesses += ['cp1252', 'latin_1']
+    encoding = next(e for e in guesses if e is not None and decodes(e))
+    if filepath is not None:
+        _file_encodings[filepath] = encoding
+        _folder_encodings[os.path.dirname(filepath)] = encoding
+    return encoding
+
 def read_and_decode(filepath):
     ''' Use this to read a file if you don't know what the encoding is '''
     with open(filepath, 'rb') as f:
         data = f.read()
-    encoding = chardet.detect(data)['encoding']
+    encoding = detect_encoding(data, filepath)
     return data.decode(encoding)
 
 ### File IO
@@ -77,45 +262,107 @@ def netlist_fromfile(filepath):
     netlist = read_and_decode(filepath).split('\n')
     return [nl.strip() for nl in netlist if nl]
 
+# Patterns of the things we read from .log files
+_log_patterns = {
+    'step': re.compile(r'^\.step (.*)$', re.M),
+    'warning': re.compile(r'^WARNING: ?(.*)$', re.M),
+    # e.g. "tnom = 27", "method = modified trap"
+    'stat': re.compile(r'^(\w[\w ]*?) = (.*)$', re.M),
+    'info': re.compile(r'^(Circuit|Date): (.*)$', re.M),
+    'elapsed': re.compile(r'^Total elapsed time: (\S+)', re.M),
+    # .meas results of a run without steps look like
+    # "vmax: MAX(v(out))=4.99 FROM 0 TO 0.01", "v1m: v(out)=2.1 at 0.001", "tcross: v(out)=2.5 AT 0.00123"
+    # or "trise=9.9e-05 FROM 5e-06 TO 0.000105" for TRIG/TARG
+    'meas': re.compile(r'^(?!WARNING)(\w+): .*?=(\S+)(?:\s+(FROM|AT|at)\s+(\S+).*)?$', re.M),
+    'meas_trig': re.compile(r'^(\w+)=(\S+) FROM \S+ TO \S+', re.M),
+    'meas_fail': re.compile(r'^Measurement "(\w+)" FAIL', re.M),
+    # With steps there is a table for each measurement, with a row for each step it didn't fail in
+    'meas_table': re.compile(r'^Measurement: (\w+)\n[ \t]*step\t(.*)\n((?:[ \t]*\d+\t.*(?:\n|$))*)', re.M),
+    # AC analysis values, e.g. "(-3.01dB,-45.1°)" or "(0.5,-0.5)"
+    'polar': re.compile(r'\(([^,]+)dB,([^,]+?)\W?\)'),
+    'cartesian': re.compile(r'\(([^,]+),([^,]+)\)'),
+}
+
+def log_value(val):
+    ''' Convert a value written in a .log file to int, float or complex if possible '''
+    val = val.strip()
+    if val.isdigit():
+        return int(val)
+    try:
+        return float(val)
+    except ValueError:
+        pass
+    try:
+        m = _log_patterns['polar'].fullmatch(val)
+        if m:
+            mag, phase = float(m[1]), float(m[2])
+            return 10**(mag / 20) * np.exp(1j * np.deg2rad(phase))
+        m = _log_patterns['cartesian'].fullmatch(val)
+        if m:
+            return complex(float(m[1]), float(m[2]))
+    except ValueError:
+        pass
+    return val
+
 def read_log(filepath):
-    ''' Read ltspice .log file and parse out some information.  Return a dict'''
+    '''
+    Read ltspice .log file and parse out some information.  Return a dict with
+    'measurements': {name: value} of the .meas results, arrays with one value per step for stepped runs,
+                    and nan where the measurement failed
+    'steps': list of dicts of the parameter values of each step, for stepped runs
+    'warnings': list of warning messages
+    'sim_time': elapsed time in seconds
+    and the statistics at the end of the log ('solver', 'method', 'totiter', ...)
+    '''
     filepath = replace_ext(filepath, 'log')
-    vprint(f'Reading {filepath}')
-    lines = read_and_decode(filepath)
-    logitems = re.findall('(.*)[=,:] (.*)', lines)
-    if not logitems:
-        # quick fix, don't know why, but sometimes we have utf-16 encoding and sometimes not
-        # chardet can't seem to detect this
-        with open(filepath, 'r', encoding='utf-16-le') as f:
-            lines = f.read()
-        logitems = re.findall('(.*)[=,:] (.*)', lines)
-    def convert_vals(val):
-        val = val.strip()
-        if val.isdigit():
-            val = np.int32(val)
-        return val
-    # might have more than one of each type (e.g. multiple WARNINGs)
-    # store them as lists of strings if there are multiple and regret it later
-    logdict = {}
-    for k,v in logitems:
-        key = k.strip()
-        if key in logdict:
-            if not isinstance(logdict[key], list):
-                logdict[key] = [logdict[key]]
-            logdict[key].append(convert_vals(v))
+    emit('read', path=filepath)
+    with stage('read_log', filepath):
+        text = read_and_decode(filepath)
+    text = text.replace('\r', '')
+    logdict = dict(_log_patterns['info'].findall(text))
+    logdict.update((k, log_value(v)) for k,v in _log_patterns['stat'].findall(text))
+    elapsed = _log_patterns['elapsed'].search(text)
+    if elapsed:
+        logdict['sim_time'] = np.float32(elapsed[1])
+    logdict['warnings'] = [w.strip() for w in _log_patterns['warning'].findall(text)]
+    # Parameter values of each step of a stepped run, e.g. ".step c=1e-06 r=1"
+    steplines = _log_patterns['step'].findall(text)
+    if steplines:
+        logdict['steps'] = [{k:log_value(v) for k,_,v in (p.partition('=') for p in sl.split())} for sl in steplines]
+
+    measurements = {}
+    for name in _log_patterns['meas_fail'].findall(text):
+        measurements[name] = np.nan
+    for name, value, keyword, at in _log_patterns['meas'].findall(text):
+        # For WHEN, the result is the time it happened
+        measurements[name] = log_value(at if keyword == 'AT' else value)
+    for name, value in _log_patterns['meas_trig'].findall(text):
+        measurements[name] = log_value(value)
+    for name, header, rows in _log_patterns['meas_table'].findall(text):
+        header = header.split('\t')
+        col = header.index('AT') + 1 if 'AT' in header else 1
+        rows = [row.split('\t') for row in rows.split('\n') if row.strip()]
+        numsteps = max(len(steplines), max((int(row[0]) for row in rows), default=0))
+        values = [np.nan] * numsteps
+        for row in rows:
+            values[int(row[0]) - 1] = log_value(row[col])
+        if all(isinstance(v, (int, float)) for v in values):
+            values = np.array(values, dtype=np.float64)
+        elif all(isinstance(v, (int, float, complex)) for v in values):
+            values = np.array(values, dtype=np.complex128)
         else:
-            logdict[key] = convert_vals(v)
-    if 'Total elapsed time' in logdict:
-        logdict['sim_time'] = np.float32(logdict['Total elapsed time'].split(' ')[0])
-        del logdict['Total elapsed time']
+            values = np.array(values, dtype=object)
+        measurements[name] = values
+    logdict['measurements'] = measurements
     return logdict
 
 def read_net(filepath):
     ''' Read ltspice .net file and parse out some information.  Return a dict'''
     netinfo = {}
     filepath = replace_ext(filepath, 'net')
-    vprint(f'Reading {filepath}')
-    netlist = netlist_fromfile(filepath)
+    emit('read', path=filepath)
+    with stage('read_net', filepath):
+        netlist = netlist_fromfile(filepath)
     netparams = get_params(netlist)
     #netfuncs = re.findall('.FUNC (.*)=(.*)', netlist)
     #netfuncs = {k:v for k,v in netfuncs}
@@ -123,92 +370,492 @@ def read_net(filepath):
     netinfo.update(netparams)
     return netinfo
 
-def read_raw(filepath):
+def read_raw_header(raw_file):
+    '''
+    Read the header of an open ltspice .raw file
+    return dict of parameters, list of column names, list of units,
+    and a dict describing the format of the data section ('encoding' and whether it is 'binary')
+    the file is left positioned at the start of the numerical data
+    '''
+    start = raw_file.tell()
+    header = bytearray(raw_file.read(2**16))
+    # XVII writes the header in utf-16, newer versions can use utf-8
+    encoding = 'utf_16_le' if header[1:2] == b'\x00' else 'utf_8'
+    # Binary: is followed by the numbers in binary, Values: by the numbers in ascii (-ascii option)
+    markers = {'\nBinary:': True, '\nValues:': False}
+    markers = {m.encode(encoding):binary for m,binary in markers.items()}
+    newline = '\n'.encode(encoding)
+    # Read bigger and bigger blocks until we have the whole header, it can be long if there are many variables
+    # The marker line has to be there up to its newline, it can end right at the end of a block
+    while True:
+        found = [(pos, m) for m in markers for pos in [header.find(m)] if pos >= 0]
+        if found:
+            pos, marker = min(found)
+            end = header.find(newline, pos + len(marker))
+            if end >= 0:
+                break
+        block = raw_file.read(len(header))
+        if not block:
+            raise ValueError(f'No data section found in {raw_file.name}')
+        header += block
+    datastart = end + len(newline)
+    raw_file.seek(start + datastart)
+    lines = header[:pos].decode(encoding, errors='ignore').split('\n')
+
+    raw_params = {}
+    for i, line in enumerate(lines):
+        if line.startswith('Variables:'):
+            break
+        tag, value_str = line.split(':', 1)
+        value_str = value_str.strip()
+        if value_str.isdigit():
+            value_str = int(value_str)
+        raw_params[tag] = value_str
+
+    # Column name lines look like "\t0\ttime\ttime"
+    colnames = []
+    units = []
+    for line in lines[i+1:]:
+        if not line.strip():
+            continue
+        _, name, unit, *_ = line.strip().split('\t')
+        colnames.append(name)
+        units.append(unit)
+
+    fmt = {'encoding': encoding, 'binary': markers[marker]}
+    return raw_params, colnames, units, fmt
+
+def open_raw(filepath):
+    '''
+    Open a .raw file for reading.
+    Files compressed by compress_raw (gzip) are decompressed into memory, and read_raw works the same on them
+    '''
+    raw_file = open(filepath, 'rb')
+    if raw_file.read(2) != b'\x1f\x8b':
+        raw_file.seek(0)
+        return raw_file
+    import gzip
+    raw_file.seek(0)
+    with raw_file:
+        raw_file = io.BytesIO(gzip.decompress(raw_file.read()))
+    raw_file.name = filepath
+    return raw_file
+
+def raw_array(raw_file, dtype, count=-1, offset=None, lazy=False):
+    '''
+    Read count values (default all) of dtype from an open .raw file, starting at offset (default where it is)
+    If lazy, the data is memory mapped rather than read
+    '''
+    dtype = np.dtype(dtype)
+    if offset is None:
+        offset = raw_file.tell()
+    if isinstance(raw_file, io.BytesIO):
+        # Decompressed file, the data is already in memory
+        buf = raw_file.getvalue()
+        if count < 0:
+            count = (len(buf) - offset) // dtype.itemsize
+        raw_file.seek(offset + count * dtype.itemsize)
+        d = np.frombuffer(buf, dtype, count=count, offset=offset)
+        return d if lazy else d.copy()
+    if lazy:
+        return np.memmap(raw_file, dtype, mode='r', offset=offset, shape=(count,))
+    raw_file.seek(offset)
+    return np.fromfile(raw_file, dtype, count=count)
+
+def read_raw_data(raw_file, fmt, dtype, count=-1):
+    '''
+    Read the next count points (default all) of the data section of an open .raw file
+    Return a structured array of the given dtype
+    '''
+    if fmt['binary']:
+        return raw_array(raw_file, dtype, count)
+    # The Values: section has one value per line, and each point starts with its index
+    # e.g. "0\t0.000000000000000e+000\n\t5.000000e+000\n..."
+    numvars = len(dtype.names)
+    if count < 0:
+        text = raw_file.read().decode(fmt['encoding'])
+    else:
+        # Reading line by line is slow, but ascii files are rare and this only happens for iter_raw
+        if 'reader' not in fmt:
+            fmt['reader'] = codecs.getreader(fmt['encoding'])(raw_file)
+        text = ''.join(islice(fmt['reader'], count * numvars))
+    iscomplex = dtype[0] == np.complex128
+    if iscomplex:
+        # complex values are written as "real,imag"
+        text = text.replace(',', ' ')
+    values = np.fromstring(text, dtype=np.float64, sep=' ')
+    # The index of each point is followed by numvars real or complex values
+    pointsize = 1 + numvars * (2 if iscomplex else 1)
+    values = values[:len(values) // pointsize * pointsize].reshape(-1, pointsize)[:, 1:]
+    if iscomplex:
+        values = np.ascontiguousarray(values).view(np.complex128)
+    d = np.empty(len(values), dtype)
+    for i, name in enumerate(dtype.names):
+        d[name] = values[:, i]
+    return d
+
+def raw_dtype(raw_params, colnames, fmt):
+    ''' numpy dtype of one point of the data in a .raw file, according to its Flags '''
+    flags = raw_params['Flags'].split()
+    numvars = len(colnames)
+    if 'complex' in flags:
+        # AC and noise analyses, every value is a pair of doubles
+        formats = [np.complex128] * numvars
+    elif 'double' in flags or not fmt['binary']:
+        # ascii values are written with double precision
+        formats = [np.float64] * numvars
+    elif raw_params['Plotname'].startswith(('Operating Point', 'Transfer Function')):
+        # These have no time/sweep axis, all values are single precision
+        formats = [np.float32] * numvars
+    else:
+        # Time values are 8 bytes, rest are 4 bytes.
+        # (raw_file_size - 930) / numpoints / ((numvars-1)*4 + 8) = 1
+        formats = [np.float64] + [np.float32] * (numvars - 1)
+    return np.dtype({'names':colnames, 'formats':formats})
+
+def check_raw_size(raw_file, raw_params, dtype):
+    ''' Raise an error if the binary data of an open .raw file is shorter than its header says '''
+    numpoints = raw_params['No. Points']
+    expected = numpoints * dtype.itemsize
+    start = raw_file.tell()
+    available = raw_file.seek(0, os.SEEK_END) - start
+    raw_file.seek(start)
+    if available < expected:
+        raise ValueError(f'{raw_file.name} is truncated: {numpoints} points need {expected} bytes of data, '
+                         f'but there are only {available}')
+
+def read_raw(filepath, lazy=False, columns=None):
     '''
     Read ltspice output .raw file.
     return dict of parameters and arrays contained in the file
     written for ltspice XVII version, but seems to work on later versions
-    Does not load parameter runs because I think those should just be done in python
+
+    columns is a list of the column names to read (default all).
+    For files in the FastAccess layout, the other columns are not even read from disk.
+
+    Parameter runs (.step) are split up, and a list with one dict per step is returned.
+    Each dict has the index of its step under the key 'step'.
+
+    If lazy, the data is memory mapped instead of loaded, and a LazyRaw is returned.
+    Columns are then only read from disk when you access them.
+    (ascii files can't be memory mapped, they are loaded anyway)
     '''
     filepath = os.path.abspath(filepath)
     filepath = replace_ext(filepath, 'raw')
 
     # Read information from the .raw file
-    vprint(f'Reading {filepath}')
-    with open(filepath, 'rb') as raw_file:
-        colnames = []
-        units = []
-        raw_params = {'filepath': filepath}
-
-        def readline():
-            line = raw_file.readline()
-            # Read the newline...
-            raw_file.read(1)
-            return line.decode(encoding='utf_16_le', errors='ignore')
-
-        # Read the header
-        line = readline()
-        while not line.startswith('Variables:'):
-            tag, value_str = line.split(':', 1)
-            value_str = value_str.strip()
-            if value_str.isdigit():
-                value_str = int(value_str)
-            raw_params[tag] = value_str
-            line = readline()
-
-        # Read the column names
-        line = readline()
-        while not line.startswith('Binary'):
-            _, name, unit = line.strip().split('\t')
-            colnames.append(name)
-            units.append(unit)
-            line = readline()
-
+    emit('read', path=filepath)
+    with stage('read_raw', filepath), open_raw(filepath) as raw_file:
+        raw_params, colnames, units, fmt = read_raw_header(raw_file)
+        raw_params = {'filepath': filepath, **raw_params}
+        columns = check_columns(columns, colnames, filepath)
+        stepped = 'stepped' in raw_params['Flags']
+        axisname = colnames[0]
+        # Steps are found using the axis, so we need it even if it wasn't asked for
+        needed = [axisname] + [c for c in columns if c != axisname] if stepped else columns
         # Read the numerical data
-        # Time values are 8 bytes, rest are 4 bytes.
-        # (raw_file_size - 930) / numpoints / ((numvars-1)*4 + 8) = 1
+        data = read_raw_columns(raw_file, raw_params, colnames, fmt, needed, lazy=lazy)
+
+    if stepped:
+        bounds = step_boundaries(raw_params, axisname, data[axisname])
+        steps = [({**raw_params, 'No. Points': stop - start, 'step': i}, {k:data[k][start:stop] for k in columns})
+                 for i, (start, stop) in enumerate(bounds)]
+    else:
+        steps = [(raw_params, data)]
+
+    if lazy:
+        out = [LazyRaw(params, cols) for params, cols in steps]
+    else:
+        # Put data and metadata together in one dict
+        out = [{**params, **{k:raw_column(v, k) for k,v in cols.items()}} for params, cols in steps]
+
+    if stepped:
+        return out
+    return out[0]
+
+def check_columns(columns, colnames, filepath):
+    ''' Return the requested columns (default all), raise KeyError if some are not in the file '''
+    if columns is None:
+        return colnames
+    missing = [c for c in columns if c not in colnames]
+    if missing:
+        raise KeyError(f'Columns {missing} are not in {filepath}')
+    return list(dict.fromkeys(columns))
+
+def read_raw_columns(raw_file, raw_params, colnames, fmt, columns, lazy=False):
+    '''
+    Read the data section of an open .raw file, positioned after the header
+    Return dict of the requested columns (unconverted, see raw_column)
+    If lazy, binary data is memory mapped rather than read
+    '''
+    numpoints = raw_params['No. Points']
+    dtype = raw_dtype(raw_params, colnames, fmt)
+    if not fmt['binary']:
+        # ascii data is parsed in one go, it has no fixed size per point to count with
+        d = read_raw_data(raw_file, fmt, dtype)
+        if len(d) < numpoints:
+            raise ValueError(f'{raw_file.name} is truncated: expected {numpoints} points, found {len(d)}')
+        return {k:d[k] for k in columns}
+
+    check_raw_size(raw_file, raw_params, dtype)
+    start = raw_file.tell()
+    if 'fastaccess' in raw_params['Flags'].split():
+        # Each column is stored in one piece, in the same order as the fields of a point
+        cols = {}
+        for k in columns:
+            coltype, coloffset = dtype.fields[k]
+            cols[k] = raw_array(raw_file, coltype, numpoints, start + numpoints * coloffset, lazy=lazy)
+        return cols
+
+    if len(columns) < len(colnames):
+        # Just the requested columns are copied out of the memory mapped file, not the whole thing
+        d = raw_array(raw_file, field_dtype(dtype, columns), numpoints, start, lazy=True)
+        return {k:d[k] if lazy else np.array(d[k]) for k in columns}
+    # d is a dreaded numpy structured array
+    d = raw_array(raw_file, dtype, numpoints, start, lazy=lazy)
+    return {k:d[k] for k in columns}
+
+def field_dtype(dtype, columns):
+    ''' dtype of a point with only some of its fields, the others are skipped over like padding '''
+    return np.dtype({'names': columns, 'formats': [dtype.fields[k][0] for k in columns],
+                     'offsets': [dtype.fields[k][1] for k in columns], 'itemsize': dtype.itemsize})
+
+def step_boundaries(raw_params, axisname, axis):
+    '''
+    Find where each step of a stepped .raw file starts and stops.
+    A new step starts wherever the axis (first column: time, frequency, ..) comes back to its first value,
+    so sweeps that go down (.dc V1 5 0 -0.5) work too
+    Return list of (start, stop) index pairs
+    '''
+    numpoints = len(axis)
+    if raw_params['Plotname'].startswith('Operating Point'):
+        # Every point is a step
+        return [(i, i + 1) for i in range(numpoints)]
+    if not numpoints:
+        return []
+    axis = np.asarray(axis).real
+    if axisname == 'time':
+        axis = np.abs(axis)
+    at_start = axis == axis[0]
+    starts = np.flatnonzero(at_start[1:] & ~at_start[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    stops = np.concatenate((starts[1:], [numpoints]))
+    return list(zip(starts.tolist(), stops.tolist()))
+
+def iter_raw(filepath, columns=None, chunk_points=1_000_000):
+    '''
+    Read an ltspice .raw file piece by piece, for files that are too big to load at once.
+    Yield dicts with arrays of the requested columns (default all) for chunk_points points at a time.
+    Stepped runs are not split up, the chunks just run through all the steps.
+    '''
+    filepath = os.path.abspath(filepath)
+    filepath = replace_ext(filepath, 'raw')
+    emit('read_chunks', path=filepath, chunk_points=chunk_points)
+    with open_raw(filepath) as raw_file:
+        raw_params, colnames, units, fmt = read_raw_header(raw_file)
+        columns = check_columns(columns, colnames, filepath)
+        numpoints = raw_params['No. Points']
+        dtype = raw_dtype(raw_params, colnames, fmt)
+        if fmt['binary']:
+            check_raw_size(raw_file, raw_params, dtype)
+        start = raw_file.tell()
+        fastaccess = 'fastaccess' in raw_params['Flags'].split()
+        for first in range(0, numpoints, chunk_points):
+            count = min(chunk_points, numpoints - first)
+            if fastaccess:
+                chunk = {}
+                for k in columns:
+                    coltype, coloffset = dtype.fields[k]
+                    chunk[k] = raw_array(raw_file, coltype, count, start + numpoints * coloffset + first * coltype.itemsize)
+            elif fmt['binary']:
+                d = raw_array(raw_file, field_dtype(dtype, columns), count, start + first * dtype.itemsize, lazy=True)
+                chunk = {k:np.array(d[k]) for k in columns}
+            else:
+                d = read_raw_data(raw_file, fmt, dtype, count=count)
+                # Copy the columns out so the rest of the chunk can be freed
+                chunk = {k:np.array(d[k]) for k in columns}
+            if not len(chunk[columns[0]]):
+                break
+            yield {k:raw_column(v, k, unpack=False) for k,v in chunk.items()}
+
+def raw_column(v, name, unpack=True):
+    ''' Convert a column read from a .raw file to how we want it '''
+    # I have no idea why this is necessary
+    if name == 'time':
+        v = np.abs(v)
+    elif name == 'frequency' and np.iscomplexobj(v):
+        # The frequency axis of AC analyses is stored as complex, but it's real
+        v = v.real
+    if unpack and v.size == 1:
+        # numpy 0d arrays are stupid
+        v = v.item()
+    return v
+
+def raw_to_fastaccess(filepath, outpath=None, chunk_points=1_000_000):
+    '''
+    Rewrite a binary .raw file in the FastAccess layout, where each column is stored in one piece.
+    Then reading a few columns doesn't need a pass through the whole file.
+    By default the file is replaced, otherwise the result is written to outpath.
+    Return the path of the converted file
+    '''
+    filepath = os.path.abspath(filepath)
+    filepath = replace_ext(filepath, 'raw')
+    outpath = filepath if outpath is None else os.path.abspath(outpath)
+    emit('convert', path=filepath)
+    with open_raw(filepath) as raw_file:
+        raw_params, colnames, units, fmt = read_raw_header(raw_file)
+        flags = raw_params['Flags'].split()
+        if not fmt['binary']:
+            raise ValueError(f'{filepath} has ascii data, only binary files can be converted')
+        if 'fastaccess' in flags:
+            if outpath != filepath:
+                import shutil
+                shutil.copyfile(filepath, outpath)
+            return outpath
         numpoints = raw_params['No. Points']
-        numvars = raw_params['No. Variables']
-        dtype = np.dtype({'names':colnames,
-                          'formats':[np.float64] + [np.float32]*(numvars - 1)})
-        # d is a dreaded numpy structured array
-        d = np.fromfile(raw_file, dtype)
-        ddict = {k:d[k] for k in colnames}
-        # I have no idea why this is necessary
-        if 'time' in ddict:
-            ddict['time'] = np.abs(ddict['time'])
-        for k,v in ddict.items():
-            if v.size == 1:
-                # numpy 0d arrays are stupid
-                ddict[k] = v.item()
-    # Put data and metadata together in one dict
-    outdict = {**raw_params, **ddict}
-
-    return outdict
-
-def read_spice(filepath, namemap=None):
-    ''' Read all the information contained in all the spice files with the same name (.raw, .net, .log)'''
+        dtype = raw_dtype(raw_params, colnames, fmt)
+        check_raw_size(raw_file, raw_params, dtype)
+        start = raw_file.tell()
+        raw_file.seek(0)
+        header = raw_file.read(start).decode(fmt['encoding'])
+        header = re.sub('^Flags:.*$', 'Flags: ' + ' '.join(flags + ['fastaccess']), header,
+                        count=1, flags=re.MULTILINE)
+        d = raw_array(raw_file, dtype, numpoints, start, lazy=True)
+        tmppath = outpath + '.tmp'
+        with open(tmppath, 'wb') as out:
+            out.write(header.encode(fmt['encoding']))
+            for k in colnames:
+                for i in range(0, numpoints, chunk_points):
+                    out.write(np.ascontiguousarray(d[k][i:i+chunk_points]).tobytes())
+        del d
+    os.replace(tmppath, outpath)
+    return outpath
+
+def compress_raw(filepath, compresslevel=6):
+    '''
+    Compress a .raw file in place with gzip.  read_raw and friends still open it directly,
+    but it has to be decompressed into memory every time, so only do this for files you rarely use.
+    Return the number of bytes saved
+    '''
+    import gzip, shutil
+    filepath = replace_ext(os.path.abspath(filepath), 'raw')
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as raw_file:
+        if raw_file.read(2) == b'\x1f\x8b':
+            # Already compressed
+            return 0
+        raw_file.seek(0)
+        tmppath = filepath + '.tmp'
+        with gzip.open(tmppath, 'wb', compresslevel=compresslevel) as out:
+            shutil.copyfileobj(raw_file, out, 2**20)
+    os.replace(tmppath, filepath)
+    return size - os.path.getsize(filepath)
+
+class LazyRaw(Mapping):
+    '''
+    Read-only dict of the parameters and columns of a .raw file, as returned by read_raw(lazy=True)
+    The data stays memory mapped, and each column is a view into the file.
+    Nothing is read (or converted) until you access a column, so memory use grows with the columns you use.
+    '''
+    def __init__(self, raw_params, columns):
+        self.params = raw_params
+        self.columns = columns
+        # Columns that needed a conversion, so we don't repeat it
+        self._converted = {}
+
+    def __getitem__(self, key):
+        if key in self.params:
+            return self.params[key]
+        if key in self._converted:
+            return self._converted[key]
+        v = raw_column(self.columns[key], key)
+        if key == 'time' or not isinstance(v, np.ndarray):
+            self._converted[key] = v
+        return v
+
+    def __iter__(self):
+        yield from self.params
+        yield from self.columns
+
+    def __len__(self):
+        return len(self.params) + len(self.columns)
+
+    def __repr__(self):
+        return f'LazyRaw({self.params["filepath"]!r}, columns={list(self.columns)})'
+
+def read_spice(filepath, namemap=None, measurements_only=False):
+    '''
+    Read all the information contained in all the spice files with the same name (.raw, .net, .log)
+    For parameter runs (.step), return a list with one dict per step,
+    which contain the parameter values and the .meas results of that step
+
+    If measurements_only, the .raw file is not read at all.  Then stepped runs also give one dict,
+    with arrays of the .meas results and a list of the parameter values of the 'steps'
+    '''
     filepath = os.path.abspath(filepath)
 
+    if measurements_only:
+        logdata = read_log(filepath)
+        netdata = read_net(filepath)
+        d = combine_spice_data({'filepath': replace_ext(filepath, 'raw')}, logdata, netdata, namemap)
+        if 'steps' in logdata:
+            d['steps'] = [step_params(netdata, s) for s in logdata['steps']]
+        return d
+
     rawdata = read_raw(filepath)
     logdata = read_log(filepath)
     netdata = read_net(filepath)
+    steps = rawdata if isinstance(rawdata, list) else [rawdata]
+    numpoints = sum(step['No. Points'] for step in steps)
+    if (pyramid_points is not None and numpoints >= pyramid_points and result_axis(steps[0])
+            and pyramid_outdated(filepath)):
+        try:
+            build_pyramid(rawdata)
+        except OSError:
+            # Only nice to have, e.g. the simfolder can be read-only
+            pass
 
+    if isinstance(rawdata, list):
+        steps = logdata.get('steps', [])
+        steps = steps + [{}] * (len(rawdata) - len(steps))
+        measurements = logdata['measurements']
+        def step_log(i):
+            # Only the .meas results of step i
+            return {**logdata, 'measurements': {k:v[i] if isinstance(v, np.ndarray) and i < len(v) else v
+                                                for k,v in measurements.items()}}
+        return [combine_spice_data(r, step_log(i), {**netdata, **step_params(netdata, s)}, namemap)
+                for i, (r, s) in enumerate(zip(rawdata, steps))]
+
+    return combine_spice_data(rawdata, logdata, netdata, namemap)
+
+def combine_spice_data(rawdata, logdata, netdata, namemap=None):
+    ''' Merge what we read from the .raw, .log and .net files into one output dict '''
     # Pick and choose the data you want to output
     dataout = {**rawdata, **netdata}
     dataout['sim_time'] = logdata.get('sim_time')
     dataout['solver'] = logdata.get('solver')
     dataout['method'] = logdata.get('method')
-    dataout['WARNING'] = logdata.get('WARNING')
+    dataout['warnings'] = logdata.get('warnings', [])
+    dataout['measurements'] = logdata.get('measurements', {})
 
     # Map to other names if you want
+    return apply_namemap(dataout, namemap)
+
+def apply_namemap(d, namemap=None):
+    ''' Rename the keys of d according to namemap {oldname: newname} '''
     if namemap is not None:
         for oldk, newk in namemap.items():
-            if oldk in dataout:
-                dataout[newk] = dataout[oldk]
-                del dataout[oldk]
+            if oldk in d:
+                d[newk] = d.pop(oldk)
+    return d
 
-    return dataout
+def step_params(netdata, stepdata):
+    '''
+    ltspice writes the stepped parameter names in lower case in the .log
+    Use the spelling of the .PARAM in the netlist if there is one
+    '''
+    names = {k.lower():k for k in netdata if k != 'netlist'}
+    return {names.get(k.lower(), k):v for k,v in stepdata.items()}
 
 def replace_ext(path, newext):
     return os.path.splitext(path)[0] + '.' + newext.strip('.')
@@ -221,128 +868,1293 @@ def valid_filename(s):
     s = str(s).strip().replace(' ', '_')
     return re.sub(r'(?u)[^-\w.]', '', s)
 
-def write_wav(times, voltages, filename):
-    import struct
+def write_wav(times, voltages, filename, samplerate=44_100, normalize=True):
+    '''
+    Write voltage waveform(s) to a 16 bit .wav file, linearly interpolated at samplerate
+    voltages is one array, or a list of arrays (or 2D array) with one per channel
+    normalize=True scales the largest |voltage| to full scale, a number sets the voltage that is full scale,
+    and False leaves the volts as they are (1 V is full scale).  Anything beyond full scale is clipped.
+    '''
     import wave
+    times = np.asarray(times, dtype=np.float64)
+    channels = np.atleast_2d(np.asarray(voltages, dtype=np.float64))
+    if normalize is True:
+        fullscale = np.max(np.abs(channels)) or 1.0
+    elif normalize is False:
+        fullscale = 1.0
+    else:
+        fullscale = normalize
+    samples = np.arange(np.ceil(times[0] * samplerate), np.floor(times[-1] * samplerate) + 1)
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(len(channels))
+        w.setsampwidth(2)
+        w.setframerate(samplerate)
+        w.writeframes(wav_frames(samples / samplerate, times, channels, fullscale))
 
-    def lin_interp(x0, x1, y0, y1, x):
-        x0 = float(x0)
-        x1 = float(x1)
-        y0 = float(y0)
-        y1 = float(y1)
-        x = float(x)
-        return y0 + (x - x0) * (y1 - y0) / (x1 - x0)
-
-    with wave.open(filename, 'w') as w:
-        SAMPLING_RATE = 44_100
-        w.setnchannels(1)
+def write_wav_chunks(chunks, filename, columns, fullscale, samplerate=44_100, timecol='time'):
+    '''
+    Write a .wav file from chunks of data, like the ones iter_raw yields, without loading everything at once.
+    Each column is a channel.  Unlike write_wav, the voltage that is full scale has to be given up front
+    '''
+    import wave
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(len(columns))
         w.setsampwidth(2)
-        w.setframerate(SAMPLING_RATE)
-        w.setnframes(0)
-        w.setcomptype('NONE')
-        w.writeframes(np.sin(np.linspace(0, 8000*2*np.pi, 100000)))
-        m = max(max(voltages), -min(voltages))
-        vrange = m
-
-        values = bytes([])
-        t = 0.0
-        step = 1.0 / SAMPLING_RATE
-
-        for i in range(len(voltages)-1):
-            while times[i] <= t * step < times[i+1]:
-                sample = lin_interp(times[i], times[i+1],
-                    voltages[i], voltages[i+1], t*step) / vrange
-                sample = 1 if sample >1 else sample
-                sample = -1 if sample <-1 else sample
-                d = struct.pack('<h',int(32767 * sample))
-                values += d
-                t += 1
-
-        w.writeframes(values)
+        w.setframerate(samplerate)
+        # Index of the next sample, and the last point of the previous chunk to interpolate from
+        k = None
+        prev_t = prev_v = None
+        for chunk in chunks:
+            times = np.asarray(chunk[timecol], dtype=np.float64)
+            channels = np.array([chunk[c] for c in columns], dtype=np.float64)
+            if not len(times):
+                continue
+            if prev_t is not None:
+                times = np.concatenate(([prev_t], times))
+                channels = np.concatenate((prev_v[:, None], channels), axis=1)
+            if k is None:
+                k = np.ceil(times[0] * samplerate)
+            last = np.floor(times[-1] * samplerate)
+            if last >= k:
+                w.writeframes(wav_frames(np.arange(k, last + 1) / samplerate, times, channels, fullscale))
+                k = last + 1
+            prev_t, prev_v = times[-1], channels[:, -1]
+
+def wav_frames(samples, times, channels, fullscale):
+    ''' Interpolate channels at the sample times and convert to interleaved 16 bit frames '''
+    frames = np.empty((len(samples), len(channels)), dtype='<i2')
+    for i, v in enumerate(channels):
+        x = np.interp(samples, times, v) / fullscale
+        np.clip(x, -1, 1, out=x)
+        frames[:, i] = x * 32767
+    return frames.tobytes()
+
+### Decimation for plotting
+# Plotting millions of points is slow, and taking every nth point hides glitches.
+# Instead the min and max of each column are kept for bins of pyramid_factor**2 points, pyramid_factor times
+# that, and so on, in a .pyr.npz file next to the .raw file.  decimate() then picks the level that has about
+# as many bins in the time window as you asked for, so its cost depends on the number of points it returns.
+# Pyramids are made when results with at least pyramid_points points are read (None turns that off),
+# or by decimate when one is missing.  Complex (AC) columns are left out.
+pyramid_factor = 8
+pyramid_points = 1_000_000
+# Pyramids that were opened recently, filepath: (mtime, {key: memory mapped array})
+_pyramids = OrderedDict()
+max_loaded_pyramids = 8
+
+def result_axis(d):
+    ''' Name of the axis column of a result, if it is one that only goes up (time or frequency) '''
+    return next((k for k in ('time', 'frequency') if k in d), None)
+
+def pyramid_path(filepath):
+    return replace_ext(filepath, 'pyr.npz')
+
+def minmax_bins(start, stop, lo, hi, size):
+    '''
+    Merge bins (or points) with axis values from start to stop and min/max values lo, hi into groups of size.
+    Return start, stop, lo, hi of the groups, lo and hi are dicts of column: array
+    '''
+    n = len(start)
+    idx = np.arange(0, n, size)
+    last = np.minimum(idx + size, n) - 1
+    return (start[idx], stop[last], {k:np.minimum.reduceat(v, idx) for k,v in lo.items()},
+            {k:np.maximum.reduceat(v, idx) for k,v in hi.items()})
+
+def pyramid_levels(d, axis=None):
+    '''
+    Min/max pyramid of the real columns of one result (or step), as a dict that np.savez can write:
+    {'{level}/start': ..., '{level}/stop': ..., '{level}/min/{column}': ..., '{level}/max/{column}': ...}
+    Level 1 has bins of pyramid_factor**2 points, each level above has pyramid_factor times bigger bins
+    '''
+    axis = axis or result_axis(d)
+    x = np.asarray(d[axis], np.float64)
+    cols = {k:v for k,v in d.items() if k != axis and isinstance(v, np.ndarray)
+            and v.shape == x.shape and not np.iscomplexobj(v)}
+    levels = {}
+    level = 1
+    bins = minmax_bins(x, x, cols, cols, pyramid_factor**2)
+    while True:
+        start, stop, lo, hi = bins
+        levels[f'{level}/start'] = start
+        levels[f'{level}/stop'] = stop
+        levels.update({f'{level}/min/{k}':v for k,v in lo.items()})
+        levels.update({f'{level}/max/{k}':v for k,v in hi.items()})
+        if len(start) <= pyramid_factor:
+            return levels
+        bins = minmax_bins(*bins, pyramid_factor)
+        level += 1
+
+def build_pyramid(d):
+    '''
+    Write the min/max pyramid of a result (output of read_raw or runspice, or list of steps) next to its .raw file
+    Return the path of the pyramid file
+    '''
+    steps = d if isinstance(d, list) else [d]
+    out = {}
+    for i, step in enumerate(steps):
+        out.update({f'{i}/{k}':v for k,v in pyramid_levels(step).items()})
+    filepath = pyramid_path(steps[0]['filepath'])
+    with _cache_lock:
+        _pyramids.pop(filepath, None)
+    with stage('pyramid_write', filepath):
+        # np.savez adds .npz if the name doesn't end with it
+        tmppath = filepath[:-4] + '.tmp.npz'
+        try:
+            np.savez(tmppath, **out)
+            os.replace(tmppath, filepath)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmppath)
+            raise
+    return filepath
+
+def pyramid_outdated(filepath):
+    ''' Whether the .raw file has no pyramid, or one that is older than it '''
+    rawpath = replace_ext(filepath, 'raw')
+    pyrpath = pyramid_path(rawpath)
+    return not os.path.isfile(pyrpath) or os.path.getmtime(pyrpath) < os.path.getmtime(rawpath)
+
+def load_pyramid(filepath):
+    '''
+    The pyramid of a .raw file as a dict of memory mapped arrays, building it first if it is missing or outdated
+    '''
+    rawpath = replace_ext(os.path.abspath(filepath), 'raw')
+    pyrpath = pyramid_path(rawpath)
+    rawtime = os.path.getmtime(rawpath)
+    with _cache_lock:
+        loaded = _pyramids.get(pyrpath)
+        if loaded is not None and loaded[0] >= rawtime:
+            _pyramids.move_to_end(pyrpath)
+            return loaded[1]
+    if pyramid_outdated(rawpath):
+        build_pyramid(read_raw(rawpath))
+    pyramid = npz_memmap(pyrpath)
+    with _cache_lock:
+        _pyramids[pyrpath] = (os.path.getmtime(pyrpath), pyramid)
+        while len(_pyramids) > max_loaded_pyramids:
+            _pyramids.popitem(last=False)
+    return pyramid
+
+def npz_memmap(filepath):
+    '''
+    Memory map all the arrays of an uncompressed .npz file (like np.savez writes), return dict of key: array
+    Nothing is read until the arrays are used, and then only the parts that are used.
+    '''
+    import zipfile
+    import struct
+    arrays = {}
+    with zipfile.ZipFile(filepath) as zf, open(filepath, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED or not info.filename.endswith('.npy'):
+                continue
+            # The data starts after the local file header, which can have a different extra field than the directory
+            f.seek(info.header_offset + 26)
+            namelen, extralen = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + namelen + extralen)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[info.filename[:-4]] = np.memmap(f, dtype, 'r', f.tell(), shape, 'F' if fortran else 'C')
+    return arrays
+
+def decimate(d, n=2000, t0=None, t1=None, columns=None):
+    '''
+    At most n points of a result for plotting the window t0 <= time <= t1 (default everything).
+    d is an output dict of runspice/read_raw (one step), or the path of a .raw file
+    (then the time axis is read, and only the parts of the other columns that are needed).
+    Results of runspice/from_cache and lazy read_raw use the pyramid stored with the .raw file,
+    for other dicts (e.g. with arrays you changed) it is made from their arrays on every call.
+    If the window has more than n points, it is split into bins and each bin gives two points:
+    the min of each column at the first time of the bin and the max at the last, so no spike goes missing.
+    The bins at the ends of the window can reach a little past t0 and t1.
+
+    Return dict of axis: array, column: array (default all the real columns), like the result dicts
+    '''
+    if isinstance(d, str):
+        d = read_raw(d, lazy=True)
+        if isinstance(d, list):
+            raise ValueError('Stepped .raw file, pass one step of read_raw(filepath, lazy=True)')
+    axis = result_axis(d)
+    if axis is None:
+        raise ValueError('Only results with a time or frequency axis can be decimated')
+    x = d[axis]
+    if columns is None:
+        columns = [k for k in d if k != axis and isinstance(d[k], np.ndarray)
+                   and d[k].shape == x.shape and not np.iscomplexobj(d[k])]
+    t0 = x[0] if t0 is None else t0
+    t1 = x[-1] if t1 is None else t1
+    first, last = np.searchsorted(x, t0, 'left'), np.searchsorted(x, t1, 'right')
+    numbins = max(n // 2, 1)
+    if last - first <= n:
+        return {axis: np.array(x[first:last]), **{k:np.array(d[k][first:last]) for k in columns}}
+
+    # Find the finest level that doesn't need more than pyramid_factor of its bins merged per output bin
+    # Level 0 is the points themselves, with pyramid_factor**2 points per bin of level 1
+    level = 0
+    pyramid = None
+    if last - first > numbins * pyramid_factor**2:
+        step = d.get('raw_step', d.get('step'))
+        prefix = f'{step or 0}/'
+        # The pyramid stored next to the .raw file is only good for the arrays as they were read from it.
+        # Those are the ones of a LazyRaw, or read-only ones (results of runspice and from_cache)
+        from_file = isinstance(d, LazyRaw) or not any(d[k].flags.writeable for k in [axis, *columns])
+        if from_file and d.get('filepath') and os.path.isfile(replace_ext(d['filepath'], 'raw')):
+            try:
+                pyramid = load_pyramid(d['filepath'])
+            except OSError:
+                # e.g. read-only folder
+                pyramid = None
+            if pyramid is not None and step is None and '1/1/start' in pyramid:
+                # Stepped file, but we don't know which step this is
+                pyramid = None
+            if pyramid is not None and not all(f'{prefix}1/min/{k}' in pyramid for k in columns):
+                # Columns that are called something else in the file (namemap)
+                pyramid = None
+        if pyramid is None:
+            # Not from a file, have to make the pyramid every time
+            pyramid = pyramid_levels(d, axis)
+            prefix = ''
+        level = 1
+        while True:
+            start, stop = pyramid[f'{prefix}{level}/start'], pyramid[f'{prefix}{level}/stop']
+            first, last = np.searchsorted(stop, t0, 'left'), np.searchsorted(start, t1, 'right')
+            if last - first <= numbins * pyramid_factor or f'{prefix}{level + 1}/start' not in pyramid:
+                break
+            level += 1
+
+    if level == 0:
+        start = stop = np.asarray(x[first:last], np.float64)
+        lo = hi = {k:np.asarray(d[k][first:last]) for k in columns}
+    else:
+        start, stop = start[first:last], stop[first:last]
+        lo = {k:pyramid[f'{prefix}{level}/min/{k}'][first:last] for k in columns}
+        hi = {k:pyramid[f'{prefix}{level}/max/{k}'][first:last] for k in columns}
+    size = -(-len(start) // numbins)
+    start, stop, lo, hi = minmax_bins(start, stop, lo, hi, size)
+    out = {axis: np.stack((start, stop), axis=1).ravel()}
+    out.update({k:np.stack((lo[k], hi[k]), axis=1).ravel() for k in columns})
+    return out
+
 
 def hash(netlist):
-    return hashlib.md5(bytes('\n'.join(netlist), 'utf-8')).hexdigest()
-
-def from_cache(netlist, namemap=None):
-    ''' Check whether the same netlist has already been run, and if yes, return the results written to disk'''
-    # Update cache
-    existing_fns = fnmatch.filter(os.listdir(simfolder), '*.net')
-    for fn in existing_fns:
-        if fn not in net_hashes.values():
-            existing_net = netlist_fromfile(os.path.join(simfolder, fn))
-            #net_hashes[fn] = hash(existing_net)
-            # only add to cache if there is corresponding output data
-            raw_exists = os.path.isfile(os.path.join(simfolder, fn[:-3] + 'raw'))
-            log_exists = os.path.isfile(os.path.join(simfolder, fn[:-3] + 'log'))
-            if raw_exists & log_exists:
-                net_hashes[hash(existing_net)] = fn
-    # Check if hash already in the cache
-    h = hash(netlist)
-    if h in net_hashes:
-        fp = os.path.join(simfolder, net_hashes[h])
-        if os.path.isfile(fp):
-            vprint('Reading the previous result of a matching simulation from disk')
-            return read_spice(fp, namemap=namemap)
+    return hash_text('\n'.join(netlist))
+
+def hash_text(text):
+    ''' hash of a netlist that is already joined into one string '''
+    return hashlib.md5(bytes(text, 'utf-8')).hexdigest()
+
+# Every finished simulation in simfolder is recorded in an sqlite database, mapping the netlist hash to its files.
+# This way from_cache doesn't need to read every netlist in the folder
+cache_index_name = 'cache_index.sqlite'
+_cache_indices = dict()
+# When results were last used is written to the index in batches, {folder: {hash: time}}
+_access_times = dict()
+_flush_at_exit_registered = False
+
+# If shard_simfolder, new runs are written to subfolders of simfolder named after the first two characters
+# of the netlist hash, so no folder gets so many files that listing it is slow.  See also prune_simfolder
+shard_simfolder = False
+
+def is_shard(name):
+    ''' Whether a subfolder of a simulation folder is a shard (named by a hash prefix) '''
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+def cache_index(folder=None):
+    '''
+    Return a connection to the cache index database of folder (default simfolder).
+    The index is created if it doesn't exist yet, and filled with the simulations already in the folder
+    '''
+    folder = os.path.abspath(folder or get_simfolder())
+    new_index = False
+    with _cache_lock:
+        db = _cache_indices.get(folder)
+        if db is None:
+            os.makedirs(folder, exist_ok=True)
+            dbpath = os.path.join(folder, cache_index_name)
+            new_index = not os.path.isfile(dbpath)
+            # Connection is shared by all threads, every access is done holding _cache_lock
+            import sqlite3
+            db = sqlite3.connect(dbpath, timeout=60, check_same_thread=False, isolation_level=None)
+            # step is set for results that are one step of a batch run (see runspice_batch)
+            db.execute('CREATE TABLE IF NOT EXISTS results (hash TEXT PRIMARY KEY, netfile TEXT NOT NULL, '
+                       'accessed REAL NOT NULL DEFAULT 0, step INTEGER)')
+            # Indexes made by older versions are missing some columns
+            # they don't record when results were last used (0 = unknown)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(results)')]
+            for name, decl in [('accessed', 'REAL NOT NULL DEFAULT 0'), ('step', 'INTEGER')]:
+                if name not in columns:
+                    db.execute(f'ALTER TABLE results ADD COLUMN {name} {decl}')
+            _cache_indices[folder] = db
+    if new_index and sim_files(folder, '*.net'):
+        emit('index_folder', path=folder)
+        rebuild_cache_index(folder)
+    return db
+
+def cache_index_add(netlist_hash, netlistfp, step=None):
+    '''
+    Record in the index of its folder that netlistfp has the results of the netlist with this hash
+    or that the results are step number step of the run of netlistfp
+    '''
+    folder, fn = os.path.split(os.path.abspath(netlistfp))
+    parent, shard = os.path.split(folder)
+    if is_shard(shard) and (parent == os.path.abspath(get_simfolder())
+                            or os.path.isfile(os.path.join(parent, cache_index_name))):
+        # In a shard, the index is in the folder above
+        folder, fn = parent, os.path.join(shard, fn)
+    db = cache_index(folder)
+    with _cache_lock:
+        db.execute('INSERT OR REPLACE INTO results (hash, netfile, accessed, step) VALUES (?, ?, ?, ?)',
+                   (netlist_hash, fn, time.time(), step))
+
+def touch_cache_entries(netlist_hashes, folder=None):
+    ''' Note that the results with these hashes were used now.  Written to the index in batches '''
+    folder = os.path.abspath(folder or get_simfolder())
+    now = time.time()
+    global _flush_at_exit_registered
+    with _cache_lock:
+        if not _flush_at_exit_registered:
+            import atexit
+            atexit.register(flush_access_times_at_exit)
+            _flush_at_exit_registered = True
+        pending = _access_times.setdefault(folder, {})
+        pending.update((h, now) for h in netlist_hashes)
+        if len(pending) >= 256:
+            flush_access_times(folder)
+
+def flush_access_times(folder=None):
+    ''' Write the pending access times to the cache index of folder (default all folders) '''
+    with _cache_lock:
+        folders = list(_access_times) if folder is None else [os.path.abspath(folder)]
+        for folder in folders:
+            pending = _access_times.pop(folder, None)
+            if pending:
+                db = cache_index(folder)
+                db.execute('BEGIN')
+                db.executemany('UPDATE results SET accessed=? WHERE hash=?', [(t, h) for h,t in pending.items()])
+                db.execute('COMMIT')
+
+def flush_access_times_at_exit():
+    ''' Last flush when python exits, the simfolder might be gone by then '''
+    import sqlite3
+    try:
+        flush_access_times()
+    except (sqlite3.Error, OSError):
+        pass
+
+def cache_index_lookup(netlist_hash, folder=None, with_step=False):
+    '''
+    Return the path of the .net file with the given hash if it has results, otherwise None
+    If with_step, return (path, step), where step is None unless the results are one step of a batch run
+    '''
+    folder = os.path.abspath(folder or get_simfolder())
+    db = cache_index(folder)
+    with _cache_lock:
+        row = db.execute('SELECT netfile, step FROM results WHERE hash=?', (netlist_hash,)).fetchone()
+    if row is None:
+        return None
+    fp = os.path.join(folder, row[0])
+    if all(os.path.isfile(replace_ext(fp, ext)) for ext in ('net', 'raw', 'log')):
+        touch_cache_entries([netlist_hash], folder)
+        return (fp, row[1]) if with_step else fp
+    # Files were deleted behind our back
+    with _cache_lock:
+        db.execute('DELETE FROM results WHERE hash=?', (netlist_hash,))
+    return None
+
+def cache_index_lookup_many(netlist_hashes, folder=None, with_step=False):
+    '''
+    Look up many hashes at once.  Return dict of hash: path of .net file, for the ones that have results
+    If with_step, the values are (path, step) like for cache_index_lookup
+    '''
+    folder = os.path.abspath(folder or get_simfolder())
+    db = cache_index(folder)
+    netlist_hashes = list(netlist_hashes)
+    rows = []
+    # sqlite limits the number of variables in a query
+    for i in range(0, len(netlist_hashes), 500):
+        chunk = netlist_hashes[i:i+500]
+        query = f'SELECT hash, netfile, step FROM results WHERE hash IN ({",".join("?" * len(chunk))})'
+        with _cache_lock:
+            rows += db.execute(query, chunk).fetchall()
+    # Batch runs have many entries for the same files, only check them once
+    exists = {}
+    found = {}
+    for h, fn, step in rows:
+        if fn not in exists:
+            exists[fn] = all(os.path.isfile(os.path.join(folder, fn[:-3] + ext)) for ext in ('net', 'raw', 'log'))
+        if exists[fn]:
+            fp = os.path.join(folder, fn)
+            found[h] = (fp, step) if with_step else fp
+    touch_cache_entries(found, folder)
+    return found
+
+def rebuild_cache_index(folder=None, verify=True):
+    '''
+    Add all the simulations in folder (default simfolder) that are missing from its cache index.
+    Needed for folders that were filled before the index existed, or by copying files around.
+    If verify, also remove the entries whose files no longer exist.
+    Return the number of entries (added, removed)
+    '''
+    folder = os.path.abspath(folder or get_simfolder())
+    db = cache_index(folder)
+    with _cache_lock:
+        indexed = db.execute('SELECT netfile, hash FROM results').fetchall()
+    existing_fns = set(sim_files(folder, '*.net'))
+    new_entries = []
+    for fn in existing_fns - {fn for fn, _ in indexed}:
+        # only add to cache if there is corresponding output data
+        raw_exists = os.path.isfile(os.path.join(folder, fn[:-3] + 'raw'))
+        log_exists = os.path.isfile(os.path.join(folder, fn[:-3] + 'log'))
+        if raw_exists & log_exists:
+            existing_net = netlist_fromfile(os.path.join(folder, fn))
+            new_entries.append((hash(existing_net), fn, None))
+            # Batch runs also have the results of each of their points
+            new_entries += [(hash(point_net), fn, i) for i, point_net in enumerate(unbatch_netlist(existing_net))]
+    stale = []
+    if verify:
+        stale = [(h,) for fn, h in indexed
+                 if not all(os.path.isfile(os.path.join(folder, fn[:-3] + ext)) for ext in ('net', 'raw', 'log'))]
+    with _cache_lock:
+        db.execute('BEGIN')
+        db.executemany('DELETE FROM results WHERE hash=?', stale)
+        db.executemany('INSERT OR REPLACE INTO results (hash, netfile, step) VALUES (?, ?, ?)', new_entries)
+        db.execute('COMMIT')
+    return len(new_entries), len(stale)
+
+def sim_files(folder, pattern='*'):
+    ''' Names of the files in a simulation folder and its shards that match pattern, relative to the folder '''
+    names = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if is_shard(entry.name):
+                    names += [os.path.join(entry.name, fn) for fn in fnmatch.filter(os.listdir(entry.path), pattern)]
+            elif fnmatch.fnmatch(entry.name, pattern) and not entry.name.startswith(cache_index_name):
+                names.append(entry.name)
+    return names
+
+### Simfolder maintenance
+def prune_simfolder(folder=None, max_bytes=None, max_age=None, compress_after=None, shard=False, dry_run=False):
+    '''
+    Keep a simulation folder (default simfolder) from growing forever.
+    Runs are dropped in order of when their results were last used, and removed from the cache index.
+
+    max_age: delete the runs that were not used for this many seconds
+    max_bytes: then delete the least recently used runs until the folder is smaller than this
+    compress_after: gzip the .raw files of runs that were not used for this many seconds (see compress_raw)
+    shard: move the runs into subfolders by netlist hash (see shard_simfolder)
+    dry_run: only count what would be done
+
+    Runs that are not in the index (failed, or still running) are only deleted by max_age, by modification time.
+    Return dict with the number of runs 'deleted', 'compressed' and 'moved', and the bytes 'freed'
+    '''
+    folder = os.path.abspath(folder or get_simfolder())
+    flush_access_times(folder)
+    db = cache_index(folder)
+    with _cache_lock:
+        indexed = db.execute('SELECT hash, netfile, accessed FROM results').fetchall()
+    # Group the files by run, everything that starts with the name of the .net file belongs to it
+    names = sorted(sim_files(folder))
+    import bisect
+    def run_files(netfile):
+        stem = netfile[:-3]
+        i = bisect.bisect_left(names, stem)
+        files = []
+        while i < len(names) and names[i].startswith(stem):
+            files.append(os.path.join(folder, names[i]))
+            i += 1
+        return files
+    def stats(files):
+        st = [os.stat(fp) for fp in files if os.path.isfile(fp)]
+        return sum(s.st_size for s in st), max((s.st_mtime for s in st), default=0)
+
+    # Batch runs have an index entry for each of their points, they are used as long as any point is
+    accessed = {}
+    hashes = {}
+    for h, netfile, t in indexed:
+        accessed[netfile] = max(accessed.get(netfile, 0), t)
+        hashes.setdefault(netfile, []).append(h)
+    runs = []
+    for netfile in fnmatch.filter(names, '*.net'):
+        files = run_files(netfile)
+        size, mtime = stats(files)
+        runs.append({'hashes': hashes.get(netfile, []), 'netfile': netfile, 'files': files, 'bytes': size,
+                     'last_used': accessed.get(netfile) or mtime})
+    runs.sort(key=lambda run: run['last_used'])
+
+    now = time.time()
+    total = sum(run['bytes'] for run in runs)
+    counts = {'deleted': 0, 'compressed': 0, 'moved': 0, 'freed': 0}
+    delete = []
+    keep = []
+    for run in runs:
+        too_old = max_age is not None and now - run['last_used'] > max_age
+        too_big = max_bytes is not None and total > max_bytes and run['hashes']
+        if too_old or too_big:
+            delete.append(run)
+            total -= run['bytes']
+            counts['freed'] += run['bytes']
+        else:
+            keep.append(run)
+    counts['deleted'] = len(delete)
+    if not dry_run:
+        # Remove from the index first, so nobody gets a result whose files are going away
+        with _cache_lock:
+            db.execute('BEGIN')
+            db.executemany('DELETE FROM results WHERE netfile=?', [(run['netfile'],) for run in delete])
+            db.execute('COMMIT')
+        forget_runs(folder, delete)
+        for run in delete:
+            for fp in run['files']:
+                try:
+                    os.remove(fp)
+                except OSError:
+                    # e.g. still memory mapped on windows, it will be an unindexed run next time
+                    pass
+        for shardname in {os.path.dirname(run['netfile']) for run in delete} - {''}:
+            try:
+                # Only succeeds if the shard is empty now
+                os.rmdir(os.path.join(folder, shardname))
+            except OSError:
+                pass
+
+    for run in keep:
+        if not run['hashes']:
+            continue
+        rawfp = os.path.join(folder, run['netfile'][:-3] + 'raw')
+        if compress_after is not None and now - run['last_used'] > compress_after and os.path.isfile(rawfp):
+            with open(rawfp, 'rb') as f:
+                compressed = f.read(2) == b'\x1f\x8b'
+            if not compressed:
+                counts['compressed'] += 1
+                if not dry_run:
+                    counts['freed'] += compress_raw(rawfp)
+        shardname = run['hashes'][0][:2]
+        if shard and not is_shard(os.path.dirname(run['netfile'])):
+            counts['moved'] += 1
+            if not dry_run:
+                os.makedirs(os.path.join(folder, shardname), exist_ok=True)
+                for fp in run['files']:
+                    os.replace(fp, os.path.join(folder, shardname, os.path.basename(fp)))
+                netfile = os.path.join(shardname, os.path.basename(run['netfile']))
+                with _cache_lock:
+                    db.execute('UPDATE results SET netfile=? WHERE netfile=?', (netfile, run['netfile']))
+                forget_runs(folder, [run])
+    return counts
+
+def forget_runs(folder, runs):
+    ''' Drop what is kept in memory about runs (from prune_simfolder) whose files are deleted or moved '''
+    result_cache_drop(key for run in runs for h in run['hashes']
+                      for key in (result_key(h), result_key(h, measurements_only=True)))
+    with _cache_lock:
+        for run in runs:
+            _pyramids.pop(pyramid_path(os.path.join(folder, run['netfile'])), None)
+
+### In-memory result cache
+# The results of recent runs are kept in memory, so asking for the same netlists over and over doesn't
+# read and parse the files every time.  The least recently used results are dropped when their arrays
+# add up to more than result_cache_bytes (0 turns the cache off).
+# Cached arrays are read-only, copy them if you need to modify them.
+result_cache_bytes = 256 * 2**20
+_result_cache = OrderedDict()
+_result_cache_info = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+def result_nbytes(d):
+    ''' Total size of the arrays in a result (or list of steps) '''
+    return sum(v.nbytes for step in (d if isinstance(d, list) else [d])
+               for v in step.values() if isinstance(v, np.ndarray))
+
+def copy_result(d, namemap=None):
+    '''
+    Copy of a result (or list of steps) that can be changed without changing the original.
+    The arrays are shared, not copied.
+    '''
+    if isinstance(d, list):
+        return [copy_result(step, namemap) for step in d]
+    d = {k:copy_containers(v) for k,v in d.items()}
+    return apply_namemap(d, namemap)
+
+def copy_containers(v):
+    ''' Copy of v if it is a dict or list, and of the dicts and lists in it.  Everything else is shared. '''
+    if isinstance(v, dict):
+        return {k:copy_containers(x) for k,x in v.items()}
+    if isinstance(v, list):
+        return [copy_containers(x) for x in v]
+    return v
+
+def freeze_arrays(v):
+    ''' Make the arrays in v read-only, also the ones in its dicts and lists (like measurements) '''
+    if isinstance(v, np.ndarray):
+        v.flags.writeable = False
+    elif isinstance(v, dict):
+        for x in v.values():
+            freeze_arrays(x)
+    elif isinstance(v, list):
+        for x in v:
+            freeze_arrays(x)
+
+def result_cache_get(netlist_hash, namemap=None):
+    ''' Copy of the cached result for the netlist hash, or None '''
+    with _cache_lock:
+        entry = _result_cache.get(netlist_hash)
+        if entry is None:
+            _result_cache_info['misses'] += 1
+            return None
+        _result_cache.move_to_end(netlist_hash)
+        _result_cache_info['hits'] += 1
+    return copy_result(entry[0], namemap)
+
+def result_cache_put(netlist_hash, d):
+    ''' Keep a result in memory.  Its arrays are made read-only, also if it is too big to keep. '''
+    freeze_arrays(d)
+    nbytes = result_nbytes(d)
+    if not d or nbytes > result_cache_bytes:
+        return
+    with _cache_lock:
+        old = _result_cache.pop(netlist_hash, None)
+        if old is not None:
+            _result_cache_info['bytes'] -= old[1]
+        _result_cache[netlist_hash] = (d, nbytes)
+        _result_cache_info['bytes'] += nbytes
+        while _result_cache_info['bytes'] > result_cache_bytes:
+            _, (_, dropped) = _result_cache.popitem(last=False)
+            _result_cache_info['bytes'] -= dropped
+
+def result_cache_drop(keys):
+    ''' Remove the results with these keys from the in-memory cache '''
+    with _cache_lock:
+        for key in keys:
+            entry = _result_cache.pop(key, None)
+            if entry is not None:
+                _result_cache_info['bytes'] -= entry[1]
+
+def result_cache_info():
+    ''' Hits, misses, number of entries and size of the in-memory result cache '''
+    with _cache_lock:
+        return dict(_result_cache_info, entries=len(_result_cache), maxbytes=result_cache_bytes)
+
+def clear_result_cache():
+    with _cache_lock:
+        _result_cache.clear()
+        _result_cache_info.update(hits=0, misses=0, bytes=0)
+
+def result_key(netlist_hash, measurements_only=False):
+    ''' Key of a result in the in-memory cache, results without the .raw data are kept separately '''
+    return netlist_hash + ':measurements' if measurements_only else netlist_hash
+
+def read_cached(netlist_hash, filepath, namemap=None, measurements_only=False, step=None, data=None):
+    '''
+    Read the result of a previous run with this netlist hash from disk, and keep it in memory
+    If step is given, the result is that step of a batch run (see runspice_batch).
+    data is the output of read_spice for filepath, if you already have it
+    '''
+    emit('cache_hit', path=filepath)
+    if data is None:
+        data = read_spice(filepath, measurements_only=measurements_only)
+    d = data if step is None else batch_point(data, step, measurements_only)
+    result_cache_put(result_key(netlist_hash, measurements_only), d)
+    return copy_result(d, namemap)
+
+def batch_point(d, i, measurements_only=False):
+    ''' Result of point i of a batch run (output of read_spice), as if that point was run by itself '''
+    if measurements_only:
+        d = {**d, 'measurements': {k:v[i] if isinstance(v, np.ndarray) and i < len(v) else v
+                                   for k,v in d['measurements'].items()}}
+        d.pop('steps', None)
+    else:
+        d = dict(d[i])
+        # Not a step of its own, but decimate needs to know which part of the .raw file it is
+        d['raw_step'] = d.pop('step', i)
+    d.pop(batch_param, None)
+    point_netlist = unbatch_netlist(d['netlist'])[i]
+    d['netlist'] = point_netlist
+    d.update(get_params(point_netlist))
+    return d
+
+def from_cache(netlist, namemap=None, measurements_only=False):
+    ''' Check whether the same netlist has already been run, and if yes, return the results '''
+    return cached_result(hash(netlist), namemap, measurements_only)
+
+def cached_result(netlist_hash, namemap=None, measurements_only=False):
+    ''' Results of the run with this netlist hash (the 'hash' of a NetlistTemplate point), or False '''
+    with stage('cache_lookup'):
+        d = result_cache_get(result_key(netlist_hash, measurements_only), namemap)
+        if d is None:
+            found = cache_index_lookup(netlist_hash, with_step=True)
+    if d is not None:
+        emit('memory_hit', hash=netlist_hash)
+        touch_cache_entries([netlist_hash])
+        return d
+    if found is not None:
+        fp, step = found
+        return read_cached(netlist_hash, fp, namemap, measurements_only, step)
 
     return False
 
-# TODO somehow stop spice from stealing focus even though no window is visible
-# TODO cache some inputs and outputs, so that you don't keep running the same simulations
-# at least cache the file locations
-#from functools import lru_cache
-#@lru_cache(maxsize=32)
-def runspice(netlist, namemap=None, timeout=None, check_cache=True):
-    ''' Run a netlist with ltspice and return all the output data '''
-    # TODO: Sometimes when spice has an error, python just hangs forever.  Need a timeout or something.
-    # TODO: add multiprocessing
-    if not os.path.isdir(simfolder):
-        os.makedirs(simfolder, exist_ok=True)
-    if type(netlist) is str:
-        netlist = netlist.split('\n')
-    if check_cache:
-        old_result = from_cache(netlist, namemap=namemap)
-        if old_result: return old_result
-    t0 = time.time()
-    # Write netlist to disk
+def write_netlist(netlist):
+    '''
+    Write netlist to a new file in simfolder and return its path.
+    Runs started in the same millisecond get a numbered suffix, so their output files never collide
+    '''
+    simfolder = get_simfolder()
+    if shard_simfolder:
+        simfolder = os.path.join(simfolder, hash(netlist)[:2])
+    os.makedirs(simfolder, exist_ok=True)
     title = valid_filename(get_title(netlist))
-    netlistfp = os.path.join(simfolder, timestamp() + f'_{title}.net')
-    netlistfp = os.path.abspath(netlistfp)
-    vprint(f'Writing {netlistfp}')
-    with open(netlistfp, 'w') as f:
+    stem = os.path.abspath(os.path.join(simfolder, timestamp() + f'_{title}'))
+    netlistfp = stem + '.net'
+    n = 0
+    while True:
+        try:
+            f = open(netlistfp, 'x')
+            break
+        except FileExistsError:
+            n += 1
+            netlistfp = f'{stem}_{n}.net'
+    emit('write_netlist', path=netlistfp)
+    with stage('netlist_write', netlistfp), f:
         f.write('\n'.join(netlist))
-    vprint(f'Executing {netlistfp}')
-    # Tell spice to execute it
-    # If error/timeout, maybe we want to keep running things, don't raise the error just return empty data
-    try:
-        subprocess.check_output([spicepath, '-b', '-Run', netlistfp], timeout=timeout)
-    except subprocess.CalledProcessError as err:
-        print(err)
-        print(read_log(replace_ext(netlistfp, 'log')))
-        return {}
-    except subprocess.TimeoutExpired as err:
-        print(err)
-        return {}
-
-    #subprocess.check_output([spicepath, '-b', '-ascii', '-Run', netlistfp])
-    # Read result
+    return netlistfp
+
+# TODO somehow stop spice from stealing focus even though no window is visible
+def runspice(netlist, namemap=None, timeout=None, check_cache=True, measurements_only=False, save=None, options=None):
+    '''
+    Run a netlist with ltspice and return all the output data
+    If the netlist has .step commands, return a list with the output data of each step
+    If measurements_only, only the .meas results and such are read, see read_spice
+    save is a list of the traces to write to the .raw file (default all), options a dict of .options,
+    see select_output.  Saving fewer traces makes the .raw files smaller and faster to read.
+    '''
+    # TODO: Sometimes when spice has an error, python just hangs forever.  Need a timeout or something.
+    import subprocess
+    os.makedirs(get_simfolder(), exist_ok=True)
+    netlist = select_output(netlist, save, options)
+    with collecting_stats() as stats:
+        if check_cache:
+            old_result = from_cache(netlist, namemap=namemap, measurements_only=measurements_only)
+            if old_result: return attach_stats(old_result, stats)
+        t0 = time.time()
+        # Write netlist to disk
+        netlistfp = write_netlist(netlist)
+        emit('execute', path=netlistfp)
+        # Tell spice to execute it
+        # If error/timeout, maybe we want to keep running things, don't raise the error just return empty data
+        try:
+            with stage('subprocess', replace_ext(netlistfp, 'raw')):
+                subprocess.check_output([get_spicepath(), '-b', '-Run', netlistfp], timeout=timeout)
+        except subprocess.CalledProcessError as err:
+            print(err)
+            print(read_log(replace_ext(netlistfp, 'log')))
+            return {}
+        except subprocess.TimeoutExpired as err:
+            print(err)
+            return {}
+
+        #subprocess.check_output([get_spicepath(), '-b', '-ascii', '-Run', netlistfp])
+        d = collect_result(netlist, netlistfp, t0, namemap=namemap, measurements_only=measurements_only)
+        return attach_stats(d, stats)
+
+def collect_result(netlist, netlistfp, t0, namemap=None, measurements_only=False):
+    ''' Read the output of a finished run started at time t0, add it to the cache index, and return the data '''
     rawfp = os.path.splitext(netlistfp)[0] + '.raw'
-    d = read_spice(rawfp, namemap=namemap)
+    netlist_hash = hash(netlist)
+    d = read_spice(rawfp, measurements_only=measurements_only)
+    cache_index_add(netlist_hash, netlistfp)
+    result_cache_put(result_key(netlist_hash, measurements_only), d)
+    d = copy_result(d, namemap)
     t1 = time.time()
     # Sim time including file io
-    d['sim_time_total'] = t1 - t0
+    for step in (d if isinstance(d, list) else [d]):
+        step['sim_time_total'] = t1 - t0
     return d
 
-def recentfile(filter='', n=0, folder=simfolder):
-    ''' Return the nth most recent filepath'''
-    filter = f'*{filter}*'
-    dirlist = os.listdir(folder)
-    matches = fnmatch.filter(dirlist, filter)
+# Maximum number of ltspice processes that arunspice will run at the same time
+max_async_runs = os.cpu_count()
+# asyncio semaphores belong to an event loop
+_async_semaphores = weakref.WeakKeyDictionary()
+
+async def arunspice(netlist, namemap=None, timeout=None, check_cache=True, measurements_only=False,
+                    save=None, options=None):
+    '''
+    asyncio version of runspice.  Run a netlist with ltspice and return all the output data
+
+    At most max_async_runs ltspice processes run at once, further runs wait for their turn.
+    If ltspice runs longer than timeout seconds (or the task is cancelled), the process is killed.
+    Reading and parsing the files is done in the default executor, so it doesn't block the event loop.
+    '''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    netlist = select_output(netlist, save, options)
+
+    def in_executor(func, *args, **kwargs):
+        # Run in the context of this task, so the stages are recorded for this run
+        context = contextvars.copy_context()
+        return loop.run_in_executor(None, partial(context.run, func, *args, **kwargs))
+
+    with collecting_stats() as stats:
+        if check_cache:
+            old_result = await in_executor(from_cache, netlist, namemap=namemap, measurements_only=measurements_only)
+            if old_result: return attach_stats(old_result, stats)
+
+        semaphore = _async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _async_semaphores[loop] = asyncio.Semaphore(max_async_runs)
+        async with semaphore:
+            t0 = time.time()
+            netlistfp = await in_executor(write_netlist, netlist)
+            emit('execute', path=netlistfp)
+            with stage('subprocess', replace_ext(netlistfp, 'raw')):
+                proc = await asyncio.create_subprocess_exec(get_spicepath(), '-b', '-Run', netlistfp,
+                                                            stdout=asyncio.subprocess.PIPE)
+                try:
+                    await asyncio.wait_for(proc.communicate(), timeout)
+                except asyncio.TimeoutError:
+                    print(f'ltspice timed out after {timeout} seconds running {netlistfp}')
+                    return {}
+                finally:
+                    # Don't leave a hung ltspice behind on timeout or cancellation
+                    if proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+            if proc.returncode != 0:
+                print(f'ltspice returned non-zero exit status {proc.returncode} running {netlistfp}')
+                print(await in_executor(read_log, netlistfp))
+                return {}
+
+        d = await in_executor(collect_result, netlist, netlistfp, t0, namemap=namemap,
+                              measurements_only=measurements_only)
+        return attach_stats(d, stats)
+
+def runspice_many(netlists, workers=None, timeout=None, namemap=None, check_cache=True, ordered=True,
+                  measurements_only=False, save=None, options=None):
+    '''
+    Run many netlists with ltspice at the same time and return all the output data
+
+    workers is the number of ltspice processes that can run at once (default: number of cpus)
+    timeout is applied to each run separately.
+    If ordered, return a list of results in the same order as the input netlists.
+    Otherwise return an iterator of (index, result) pairs in the order that the runs finish.
+
+    If check_cache, identical netlists are only run once
+    measurements_only, save and options are the same as for runspice
+    '''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    netlists = [select_output(nl, save, options) for nl in netlists]
+    if check_cache:
+        # Identical netlists would all miss the cache if they run at the same time
+        groups = {}
+        for i, nl in enumerate(netlists):
+            groups.setdefault(hash(nl), []).append(i)
+        groups = list(groups.values())
+    else:
+        groups = [[i] for i in range(len(netlists))]
+    if workers is None:
+        workers = os.cpu_count()
+    os.makedirs(get_simfolder(), exist_ok=True)
+
+    # ltspice does the work in its own process, so threads are enough here
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {pool.submit(runspice, netlists[idxs[0]], namemap=namemap, timeout=timeout,
+                           check_cache=check_cache, measurements_only=measurements_only): idxs for idxs in groups}
+
+    def finished():
+        with pool:
+            for future in as_completed(futures):
+                d = future.result()
+                for n, i in enumerate(futures[future]):
+                    if n > 0:
+                        # Duplicates get their own copy of the data
+                        d = [dict(step) for step in d] if isinstance(d, list) else dict(d)
+                    yield i, d
+
+    if not ordered:
+        return finished()
+    results = [None] * len(netlists)
+    for i, d in finished():
+        results[i] = d
+    return results
+
+def sweep(netlist, points, workers=None, timeout=None, namemap=None, check_cache=True, measurements_only=False,
+          batch_size=None):
+    '''
+    Run netlist for every point of a parameter sweep, in parallel (see runspice_many)
+    points is a list of dicts of .PARAM values, e.g. from param_grid()
+    netlist can also be a NetlistTemplate, otherwise it is compiled into one for the swept parameters
+    The whole sweep is checked against the cache before anything is launched.
+
+    If batch_size, up to that many points are run by one ltspice process (see runspice_batch).
+    For small circuits this is much faster, because starting ltspice takes longer than the simulation.
+
+    Return list of results in the same order as points
+    '''
+    points = list(points)
+    if not isinstance(netlist, NetlistTemplate):
+        names = list(dict.fromkeys(k for point in points for k in point))
+        netlist = NetlistTemplate(netlist, names)
+    hashes = netlist.hashes(points)
+    found = cache_index_lookup_many(hashes, with_step=True) if check_cache else {}
+    misses = [i for i,h in enumerate(hashes) if h not in found]
+    emit('sweep', cached=len(points) - len(misses), total=len(points), running=len(misses))
+    results = [None] * len(points)
+    if batch_size and can_batch(netlist, [points[i] for i in misses]):
+        from concurrent.futures import ThreadPoolExecutor
+        batches = [misses[k:k+batch_size] for k in range(0, len(misses), batch_size)]
+        pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        futures = [pool.submit(runspice_batch, netlist, [points[i] for i in batch], namemap=namemap,
+                               timeout=timeout, check_cache=check_cache, measurements_only=measurements_only)
+                   for batch in batches]
+        def running():
+            with pool:
+                for batch, future in zip(batches, futures):
+                    yield from zip(batch, future.result())
+    else:
+        texts = [netlist.text(points[i]).split('\n') for i in misses]
+        finished = runspice_many(texts, workers=workers, timeout=timeout, namemap=namemap,
+                                 check_cache=check_cache, ordered=False, measurements_only=measurements_only)
+        def running():
+            for j, d in finished:
+                yield misses[j], d
+    running = running()
+    # Read the cached results while ltspice runs the rest
+    batch_data = {}
+    for i,h in enumerate(hashes):
+        if h in found:
+            results[i] = result_cache_get(result_key(h, measurements_only), namemap)
+            if results[i] is None:
+                fp, step = found[h]
+                if step is not None and fp not in batch_data:
+                    # Points of the same batch run are usually next to each other, read its files once
+                    batch_data = {fp: read_spice(fp, measurements_only=measurements_only)}
+                results[i] = read_cached(h, fp, namemap, measurements_only, step, batch_data.get(fp))
+    for i, d in running:
+        results[i] = d
+    return results
+
+def runspice_batch(netlist, points, namemap=None, timeout=None, check_cache=True, measurements_only=False):
+    '''
+    Run many points of a parameter sweep with one ltspice process, as the steps of one netlist.
+    netlist is a NetlistTemplate, points a list of dicts of .PARAM values (numbers only, see can_batch)
+    Each swept .PARAM becomes a table() of its values, indexed by a stepped batch parameter.
+
+    Return list of results, one per point, the same as runspice would give for each point by itself
+    Each point also gets its own cache entry, so runspice/from_cache find it later
+    '''
+    batch = batch_netlist(netlist, points)
+    out = runspice(batch, timeout=timeout, check_cache=check_cache, measurements_only=measurements_only)
+    steps = [out] if isinstance(out, dict) else out
+    if not out or (not measurements_only and len(steps) != len(points)):
+        return [{} for _ in points]
+    netlistfp = replace_ext(steps[0]['filepath'], 'net')
+    results = []
+    for i, h in enumerate(netlist.hashes(points)):
+        d = batch_point(out, i, measurements_only)
+        cache_index_add(h, netlistfp, step=i)
+        result_cache_put(result_key(h, measurements_only), d)
+        results.append(copy_result(d, namemap))
+    # The points share their arrays with the whole batch, don't keep (and count) them twice
+    result_cache_drop([result_key(hash(batch), measurements_only)])
+    return results
+
+def adaptive_sweep(netlist, param, metric, lo=None, hi=None, budget=50, initial=9, log=False, min_step=None,
+                   workers=None, timeout=None, namemap=None, check_cache=True, measurements_only=False,
+                   batch_size=None):
+    '''
+    Sweep one .PARAM from lo to hi, putting the points where the response changes the most.
+    metric(result) turns each result into a number, e.g. lambda d: np.max(d['I(R1)'])
+    lo and hi default to 0.5 and 1.5 times the value of the .PARAM in the netlist.
+
+    Starts with initial evenly spaced points (log spaced if log), then keeps splitting the intervals with the
+    biggest score in half until budget points have been run.  An interval's score is its length when the
+    parameter and metric ranges are both scaled to 1, so steps in the metric get refined first,
+    and the rest still gets filled in.  Intervals narrower than min_step (default (hi - lo) / 1e6) are not split.
+    Each round splits as many intervals as there are workers, and runs their midpoints with sweep().
+
+    Return (values, metrics, results) sorted by the parameter value
+    '''
+    template = netlist if isinstance(netlist, NetlistTemplate) else NetlistTemplate(netlist, [param])
+    if lo is None or hi is None:
+        value = float(template.defaults[param])
+        lo = 0.5 * value if lo is None else lo
+        hi = 1.5 * value if hi is None else hi
+    if log:
+        lo, hi = np.log10(lo), np.log10(hi)
+    if min_step is None:
+        min_step = (hi - lo) / 1e6
+    workers = workers or os.cpu_count()
+
+    xs = []
+    ys = []
+    results = []
+    def run(newxs):
+        points = [{param: float(10**x if log else x)} for x in newxs]
+        for x, d in zip(newxs, sweep(template, points, workers=workers, timeout=timeout, namemap=namemap,
+                                     check_cache=check_cache, measurements_only=measurements_only,
+                                     batch_size=batch_size)):
+            xs.append(x)
+            # Failed runs just don't get refined
+            ys.append(float(metric(d)) if d else np.nan)
+            results.append(d)
+
+    run(np.linspace(lo, hi, max(min(initial, budget), 2)))
+    while len(xs) < budget:
+        order = np.argsort(xs)
+        x = np.array(xs)[order]
+        y = np.array(ys)[order]
+        dx = np.diff(x) / ((hi - lo) or 1)
+        yrange = np.nanmax(y) - np.nanmin(y) if np.isfinite(y).any() else 0
+        dy = np.diff(y) / (yrange or 1)
+        score = np.nan_to_num(np.hypot(dx, dy))
+        score[np.diff(x) < 2 * min_step] = 0
+        best = np.argsort(score)[::-1][:min(workers, budget - len(xs))]
+        best = best[score[best] > 0]
+        if not len(best):
+            break
+        emit('refine', param=param, count=len(best), done=len(xs), budget=budget)
+        run((x[best] + x[best + 1]) / 2)
+
+    order = np.argsort(xs)
+    values = np.array(xs)[order]
+    return (10**values if log else values), np.array(ys)[order], [results[i] for i in order]
+
+def param_grid(**ranges):
+    '''
+    All combinations of the parameter values, as a list of dicts for sweep()
+    e.g. param_grid(R=[1, 2], C=np.linspace(1e-6, 2e-6, 3)) has 6 points
+    '''
+    names = list(ranges)
+    return [dict(zip(names, values)) for values in product(*ranges.values())]
+
+def recentfile(filter='', n=0, folder=None):
+    ''' Return the nth most recent filepath in folder (default simfolder) '''
+    folder = folder or get_simfolder()
+    matches = sim_files(folder, f'*{filter}*')
     matchingfps = [os.path.join(folder, m) for m in matches]
     # might be able to just assume they are in sorted order because of the file names...
     recent = np.argsort([os.path.getmtime(f) for f in matchingfps])
     return os.path.join(folder, matches[recent[-1-n]])
 
 
+### Comparing runs
+# Every run has its own adaptive time steps.  To compare many runs (e.g. the results of a sweep) they are
+# interpolated onto the same axis values, so each signal becomes one (runs, points) array.
+
+def resample_runs(results, grid, columns=None, axis=None, workers=None, chunk_runs=256):
+    '''
+    Interpolate many runs onto a common grid of axis values (time, frequency, ..)
+    results is a list of output dicts of runspice (stepped results count as one run per step),
+    or of netlist hashes (e.g. NetlistTemplate.hashes) of runs that are in the cache.
+    grid is an array of axis values, or a number of points spread over the range that all the runs cover.
+    columns are the signals to resample (default all the ones that every run has)
+
+    Return dict of axis: grid, column: float32 array with one row per run (complex64 for AC data),
+    and 'params': dict of .PARAM name: array of its value in each row.
+    Points of the grid outside of the range of a run are NaN in its row, failed runs are all NaN.
+
+    Runs are interpolated chunk_runs at a time, by up to workers threads (default number of cpus)
+    '''
+    runs = []
+    for r in results:
+        if isinstance(r, str):
+            d = cached_result(r)
+            if not d:
+                raise KeyError(f'No cached result for netlist hash {r}')
+            r = d
+        runs.extend(r if isinstance(r, list) else [r])
+    if not runs:
+        raise ValueError('No runs to resample')
+    if axis is None:
+        axis = next((result_axis(r) for r in runs if result_axis(r)), 'time')
+    ok = [i for i,r in enumerate(runs) if axis in r]
+    if not ok:
+        raise ValueError(f'None of the runs have a {axis} column')
+    xs = [np.asarray(runs[i][axis], np.float64).ravel() for i in ok]
+    if np.ndim(grid) == 0:
+        grid = np.linspace(max(x[0] for x in xs), min(x[-1] for x in xs), int(grid))
+    grid = np.asarray(grid, np.float64)
+    if columns is None:
+        columns = [k for k,v in runs[ok[0]].items() if k != axis and isinstance(v, np.ndarray)
+                   and v.shape == xs[0].shape and all(k in runs[i] for i in ok)]
+
+    out = {axis: grid}
+    for c in columns:
+        dtype = np.complex64 if any(np.iscomplexobj(runs[i][c]) for i in ok) else np.float32
+        out[c] = np.full((len(runs), len(grid)), np.nan, dtype)
+
+    def chunk(first):
+        stop = min(first + chunk_runs, len(ok))
+        x, queries, outside = shifted_axes(xs[first:stop], grid)
+        for c in columns:
+            y = np.concatenate([np.asarray(runs[i][c]).ravel() for i in ok[first:stop]])
+            rows = np.interp(queries.ravel(), x, y).reshape(queries.shape)
+            rows[outside] = np.nan
+            out[c][ok[first:stop]] = rows
+
+    with stage('resample'):
+        firsts = range(0, len(ok), chunk_runs)
+        if len(firsts) > 1 and workers != 1:
+            from concurrent.futures import ThreadPoolExecutor
+            # np.interp lets go of the GIL
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+                list(pool.map(chunk, firsts))
+        else:
+            for first in firsts:
+                chunk(first)
+
+    names = list(dict.fromkeys(k for r in runs for k in get_params(r.get('netlist', []))))
+    out['params'] = {k:param_column([r.get(k) for r in runs]) for k in names}
+    return out
+
+def shifted_axes(xs, grid):
+    '''
+    Put many axes xs one after the other into a single increasing axis, by shifting each one past the end
+    of the previous one, so one np.interp call can interpolate all the runs onto the grid at once.
+    Return the shifted axis, the grid shifted the same way for each run (shape (len(xs), len(grid))),
+    and a mask of the grid points that are outside of each run
+    '''
+    lengths = [len(x) for x in xs]
+    x = np.concatenate(xs)
+    lo, hi = x.min(), x.max()
+    span = (hi - lo) * 1.5 or 1.0
+    shift = np.arange(len(xs)) * span
+    shifted = x - lo
+    shifted += np.repeat(shift, lengths)
+    queries = (np.clip(grid, lo, hi) - lo) + shift[:, np.newaxis]
+    firsts = np.array([x[0] for x in xs])
+    lasts = np.array([x[-1] for x in xs])
+    outside = (grid < firsts[:, np.newaxis]) | (grid > lasts[:, np.newaxis])
+    return shifted, queries, outside
+
+def param_column(values):
+    ''' Array of the values of a parameter in many runs, float if they are all numbers (missing ones NaN) '''
+    try:
+        return np.array([np.nan if v is None else v for v in values], np.float64)
+    except (TypeError, ValueError):
+        return np.array(values, object)
+
+
+### Results store
+# A store is a zip file that results of many runs are appended to, so they can be queried later
+# without reading the .raw/.log/.net files again.
+# Arrays are stored compressed as data/<run>/<column>.npy, the rest of each result (params, log info, netlist)
+# goes into the json metadata of the batch it was appended with, meta/<first run>.json
+# The .meas results are stored as meas.<name>, so they can be queried like the parameters
+
+def store_results(storepath, results):
+    '''
+    Append results (one output dict of runspice, or a list of them) to the store at storepath.
+    Stepped results are stored as one run per step.
+    Only one process should write to a store at a time.
+    Return the run numbers they were given in the store
+    '''
+    import zipfile
+    import json
+    if isinstance(results, Mapping):
+        results = [results]
+    # Stepped results are lists of dicts, failed runs are empty dicts
+    results = [r for res in results for r in (res if isinstance(res, list) else [res]) if r]
+    if not results:
+        return []
+    with zipfile.ZipFile(storepath, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+        # Metadata of each append goes in meta/<its first run>.json, so names never repeat
+        first = max((m['run'] for m in store_meta(zf)), default=-1) + 1
+        metas = []
+        for run, result in enumerate(results, first):
+            meta = {'run': run}
+            result = dict(result)
+            for k,v in result.pop('measurements', {}).items():
+                result[f'meas.{k}'] = v
+            for k,v in result.items():
+                if isinstance(v, np.ndarray) and v.ndim > 0:
+                    with zf.open(f'data/{run}/{k}.npy', 'w', force_zip64=True) as f:
+                        np.lib.format.write_array(f, np.ascontiguousarray(v), allow_pickle=False)
+                else:
+                    meta[k] = jsonable(v)
+            metas.append(meta)
+        zf.writestr(f'meta/{first}.json', json.dumps(metas))
+    emit('store', count=len(results), path=storepath)
+    return list(range(first, first + len(results)))
+
+def jsonable(v):
+    ''' Convert metadata value to something json can write '''
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, complex):
+        # Turned back into complex by store_meta
+        return {'real': v.real, 'imag': v.imag}
+    if isinstance(v, Mapping):
+        return {str(k):jsonable(x) for k,x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [jsonable(x) for x in v]
+    if v is None or isinstance(v, (str, int, float, bool)):
+        return v
+    return str(v)
+
+def from_json(v):
+    ''' Undo what jsonable did to complex numbers '''
+    if isinstance(v, dict):
+        if v.keys() == {'real', 'imag'}:
+            return complex(v['real'], v['imag'])
+        return {k:from_json(x) for k,x in v.items()}
+    if isinstance(v, list):
+        return [from_json(x) for x in v]
+    return v
+
+def store_meta(zf):
+    ''' Return list of the metadata dicts of all the runs in an open store, ordered by run number '''
+    import json
+    metas = []
+    for name in zf.namelist():
+        if name.startswith('meta/'):
+            metas.extend(from_json(json.loads(zf.read(name))))
+    return sorted(metas, key=lambda m: m['run'])
+
+def query_store(storepath, columns=None, **conditions):
+    '''
+    Load the runs in the store at storepath that match all the conditions.
+    Conditions are keyword arguments on the metadata:
+        R=(1, 2)             value between 1 and 2 (inclusive)
+        solver='Normal'      equal value
+        C=lambda c: c < 1e-6 any function that returns True for the runs you want
+    .meas results are queried by meas.<name>, e.g. query_store(path, **{'meas.vmax': (1, 2)})
+    columns is a list of array names to load for the matching runs (default all, [] for metadata only)
+    Return list of dicts, one per run, with the .meas results also put back together under 'measurements'
+    '''
+    import zipfile
+    with zipfile.ZipFile(storepath, 'r') as zf:
+        def match(meta):
+            for k,cond in conditions.items():
+                if k not in meta:
+                    return False
+                v = meta[k]
+                if callable(cond):
+                    if not cond(v):
+                        return False
+                elif isinstance(cond, tuple) and len(cond) == 2:
+                    try:
+                        if not cond[0] <= v <= cond[1]:
+                            return False
+                    except TypeError:
+                        # e.g. None, or a parameter that was an expression like '{2*L}'
+                        return False
+                elif v != cond:
+                    return False
+            return True
+        runs = [m for m in store_meta(zf) if match(m)]
+        names = set(zf.namelist())
+        for meta in runs:
+            prefix = f'data/{meta["run"]}/'
+            if columns is None:
+                cols = [n[len(prefix):-4] for n in names if n.startswith(prefix)]
+            else:
+                cols = [c for c in columns if prefix + c + '.npy' in names]
+            for c in cols:
+                with zf.open(prefix + c + '.npy') as f:
+                    meta[c] = np.lib.format.read_array(f, allow_pickle=False)
+            meta['measurements'] = {k[5:]:v for k,v in meta.items() if k.startswith('meas.')}
+    return runs
+
 ### Netlist parsing
 def get_params(netlist):
     params = re.findall('.PARAM (.*)=(.*)', '\n'.join(netlist), re.IGNORECASE)
@@ -365,51 +2177,165 @@ def get_title(netlist):
 
 
 ### Functions for operating on netlist
-def netinsert(netlist, newline):
+def line_key(line):
     '''
-    Replace a line in the netlist if it corresponds to an existing command,
-    or else add it as a new line in a reasonable position
-    Does not check if you are putting in a command that makes sense or will run!
-    Return the netlist with the inserted line
+    The part of a netlist line that identifies what the command does, in lower case.
+    e.g. 'r1' for 'R1 in N001 {R}', '.param r=' for '.PARAM R=1', '.tran' for '.tran 0 10m 0'
+    A new line replaces the first existing line that has the same key
     '''
     # Spice language is not very uniform so it's not completely trivial how to decide
     # When to replace a line or when to add a new line.
-    netlist = netlist.copy()
-    # Find the part of the string that identifies what the command does
-    cmd, *rest = newline.split(' ', 1)
-    if cmd.lower() in ('.param', '.func', '.ic'):
+    if line.startswith('*'):
+        # Comments, the first one is the title
+        return '*'
+    cmd = line.split(' ', 1)[0].lower()
+    if cmd in ('.param', '.func', '.ic') and '=' in line:
         # Compare also with the thing before the = sign
-        cmd_id = newline[:newline.find('=') + 1]
-    else:
-        cmd_id = cmd
+        return line[:line.find('=') + 1].lower()
+    return cmd
+
+def line_kind(key):
+    ''' What kind of line has this key: the directive for commands, the first letter for elements '''
+    if key.startswith('.'):
+        return key.split(' ', 1)[0]
+    return key[:1]
+
+class Netlist:
+    '''
+    Netlist that can take a lot of changes quickly, for when lists of strings get too slow.
+
+    Lines are indexed by their key (see line_key) and their kind (see line_kind),
+    so replacing or inserting a line doesn't need to search through the whole netlist.
+    New lines are placed after the last line of the same kind
+    (or after the most similar line, if there is no line of that kind yet).
 
-    # How similar is each line to the identifying string?
-    # I will put the new line after the one most similar to it
-    # There's probably a better approach.
-    def similarity(netlist, line):
+    Convert back to a list of strings with list(net) or net.lines(), or to text with str(net)
+    '''
+    def __init__(self, netlist=()):
+        if type(netlist) is str:
+            netlist = netlist.split('\n')
+        # Lines are a linked list, so that inserting doesn't shift the index of all the following lines
+        self._text = list(netlist)
+        self._next = list(range(1, len(self._text) + 1))
+        if self._next:
+            self._next[-1] = None
+        self._head = 0 if self._text else None
+        self._keys = {}
+        self._last = {}
+        for i, line in enumerate(self._text):
+            key = line_key(line)
+            self._keys.setdefault(key, i)
+            self._last[line_kind(key)] = i
+
+    def __iter__(self):
+        i = self._head
+        while i is not None:
+            yield self._text[i]
+            i = self._next[i]
+
+    def __len__(self):
+        return len(self._text)
+
+    def __str__(self):
+        return '\n'.join(self)
+
+    def __repr__(self):
+        return f'Netlist({self.lines()!r})'
+
+    def lines(self):
+        return list(self)
+
+    def copy(self):
+        new = Netlist.__new__(Netlist)
+        new._text = self._text.copy()
+        new._next = self._next.copy()
+        new._head = self._head
+        new._keys = self._keys.copy()
+        new._last = self._last.copy()
+        return new
+
+    def insert(self, newline):
         '''
-        Return the number of characters that are the same as 'line' for each line of netlist
+        Replace a line if it corresponds to an existing command,
+        or else add it as a new line in a reasonable position
         '''
-        # This is not the most efficient thing ever but who cares
-        def compare(str1, str2):
-            if str1.lower().startswith(str2.lower()):
-                return len(str2)
-            else:
-                return [c1.lower() == c2.lower() for c1,c2 in zip(str1, str2)].index(False)
-        return [compare(l, line) for l in netlist]
-
-    simi = similarity(netlist, cmd_id)
-    maxsim = max(simi)
-    if maxsim == len(cmd_id):
-        # Replace existing line
-        i = simi.index(maxsim)
-        netlist[i] = newline
-    else:
-        # Find a good index to insert the new line
-        # (After the most similar line)
-        i = np.argmax(simi) + 1
-        netlist.insert(i, newline)
+        key = line_key(newline)
+        i = self._keys.get(key)
+        if i is not None:
+            self._text[i] = newline
+            return
+        kind = line_kind(key)
+        after = self._last.get(kind)
+        if after is None:
+            after = self._most_similar(key)
+        i = len(self._text)
+        self._text.append(newline)
+        if after is None:
+            self._next.append(self._head)
+            self._head = i
+        else:
+            self._next.append(self._next[after])
+            self._next[after] = i
+        self._keys[key] = i
+        self._last[kind] = i
+
+    def _most_similar(self, key):
+        ''' Index of the first line that starts with the most characters of key (None if empty) '''
+        best, bestsim = None, -1
+        i = self._head
+        while i is not None:
+            line = self._text[i].lower()
+            sim = 0
+            for c1, c2 in zip(line, key):
+                if c1 != c2:
+                    break
+                sim += 1
+            if sim > bestsim:
+                best, bestsim = i, sim
+            i = self._next[i]
+        return best
+
+    def change(self, *newlines, **params):
+        ''' Insert any (potentially nested) list of strings, and .PARAMs given as keyword arguments '''
+        for newline in chain(flatten(newlines), (param(k, v) for k,v in params.items())):
+            self.insert(newline)
+
+def netlist_lines(netlist):
+    ''' Netlist as a list of strings, whether it was given as one, as a string, or as a Netlist '''
+    if type(netlist) is str:
+        return netlist.split('\n')
+    if isinstance(netlist, Netlist):
+        return netlist.lines()
+    return netlist
+
+def netinsert(netlist, newline):
+    '''
+    Replace a line in the netlist if it corresponds to an existing command,
+    or else add it as a new line in a reasonable position
+    Does not check if you are putting in a command that makes sense or will run!
+    Return the netlist with the inserted line
+    '''
+    net = Netlist(netlist)
+    net.insert(newline)
+    return net.lines()
 
+def select_output(netlist, save=None, options=None):
+    '''
+    Make ltspice write only the traces in save (list of names like 'V(out)') to the .raw file,
+    and add the options dict to the .options of the netlist.
+    .meas can only use the traces that are saved
+    '''
+    netlist = netlist_lines(netlist)
+    if save:
+        netlist = netinsert(netlist, save_traces(*save))
+    if options:
+        existing = {}
+        for line in netlist:
+            if line.lower().startswith('.options '):
+                for opt in line.split()[1:]:
+                    k, eq, v = opt.partition('=')
+                    existing[k] = v if eq else True
+        netlist = netinsert(netlist, spice_options(**{**existing, **options}))
     return netlist
 
 def netchange(netlist, *newlines, **params):
@@ -420,14 +2346,111 @@ def netchange(netlist, *newlines, **params):
 
     Return the resulting merged netlist
     '''
-    strings = flatten(newlines)
+    # Index the netlist once for all the changes
+    net = Netlist(netlist)
+    net.change(*newlines, **params)
+    return net.lines()
 
-    if params:
-        spice_params = [param(k, v) for k,v in params.items()]
-    else:
-        spice_params = []
+class NetlistTemplate:
+    '''
+    Netlist compiled once for a parameter sweep.
+    The .PARAM lines of the given parameter names become slots, so each variant of the netlist is made by just
+    filling in the values.  The result is the same netlist that paramchange would make.
+
+    template = NetlistTemplate(netlist, ['R', 'C'])
+    template.render(R=2, C=1e-6)  ->  list of strings, same as paramchange(netlist, R=2, C=1e-6)
 
-    return reduce(netinsert, chain(strings, spice_params), netlist)
+    Parameters you don't give keep the value they have in the netlist
+    '''
+    def __init__(self, netlist, names=None):
+        netlist = netlist_lines(netlist)
+        values = dict(re.findall('.PARAM (.*)=(.*)', '\n'.join(netlist), re.IGNORECASE))
+        if names is None:
+            names = list(values)
+        self.names = list(names)
+        self.defaults = {k:values[k] for k in self.names if k in values}
+        # Put a marker in each slot, then cut the text up at the markers
+        net = Netlist(netlist)
+        net.change(**{k:f'\x00{i}\x00' for i,k in enumerate(self.names)})
+        pieces = re.split('\x00(\\d+)\x00', str(net))
+        self._chunks = pieces[0::2]
+        self._slots = [self.names[int(i)] for i in pieces[1::2]]
+        # Hash of the text before the first slot is the same for every variant
+        self._prefix_hash = hashlib.md5(bytes(self._chunks[0], 'utf-8'))
+
+    def _values(self, values, kwargs):
+        values = {**self.defaults, **(values or {}), **kwargs}
+        missing = [k for k in self._slots if k not in values]
+        if missing:
+            raise KeyError(f'No values given for parameters {missing}')
+        return values
+
+    def text(self, values=None, **kwargs):
+        ''' Netlist with the parameter values filled in, as one string '''
+        values = self._values(values, kwargs)
+        pieces = [self._chunks[0]]
+        for name, chunk in zip(self._slots, self._chunks[1:]):
+            pieces.append(f'{values[name]}')
+            pieces.append(chunk)
+        return ''.join(pieces)
+
+    def render(self, values=None, **kwargs):
+        ''' Netlist with the parameter values filled in, as a list of strings '''
+        return self.text(values, **kwargs).split('\n')
+
+    def hashes(self, points):
+        ''' hash() of the netlists for a list of dicts of parameter values, without rendering them all into lists '''
+        out = []
+        for point in points:
+            values = self._values(point, {})
+            h = self._prefix_hash.copy()
+            for name, chunk in zip(self._slots, self._chunks[1:]):
+                h.update(bytes(f'{values[name]}{chunk}', 'utf-8'))
+            out.append(h.hexdigest())
+        return out
+
+# Name of the .PARAM that batch runs step through
+batch_param = 'batchpoint'
+
+def can_batch(template, points):
+    ''' Whether the points can be run as a batch (see runspice_batch) '''
+    if re.search(r'^\.step', ''.join(template._chunks), re.MULTILINE | re.IGNORECASE):
+        # The netlist is stepped already
+        return False
+    for point in points:
+        values = template._values(point, {})
+        for name in template._slots:
+            try:
+                float(f'{values[name]}')
+            except ValueError:
+                # table() only takes numbers
+                return False
+    return True
+
+def batch_netlist(template, points):
+    '''
+    Netlist that runs all the points as steps.  Return list of strings
+    e.g. .PARAM R=table(batchpoint,1,10,2,20,3,30) and .step param batchpoint list 1 2 3
+    '''
+    values = [template._values(point, {}) for point in points]
+    tables = {name: f'table({batch_param},' + ','.join(f'{i + 1},{v[name]}' for i,v in enumerate(values)) + ')'
+              for name in template.names}
+    batch = template.render(tables)
+    steps = ' '.join(str(i + 1) for i in range(len(points)))
+    return netinsert(batch, f'.step param {batch_param} list {steps}')
+
+def unbatch_netlist(netlist):
+    ''' Netlists of the points of a batch netlist made by batch_netlist.  Empty list if it isn't one '''
+    stepline = f'.step param {batch_param} list '
+    steps = [line for line in netlist if line.lower().startswith(stepline)]
+    if not steps:
+        return []
+    numpoints = len(steps[0].split()) - 4
+    lines = [line for line in netlist if not line.lower().startswith(stepline)]
+    table = re.compile(f'table\\({batch_param},([^)]*)\\)')
+    def point(i):
+        return [table.sub(lambda m: m[1].split(',')[2*i + 1], line) for line in lines]
+    return [point(i) for i in range(numpoints)]
 
 def netchanger(netlist):
     ''' Closure that remembers the input netlist, and allows you to modify it by passing partial netlists '''
@@ -505,6 +2528,17 @@ def transient(start=0, stop=1, maxstep=1e-4, stopsteady=False):
 def initial_condition(name, value):
     return f'.ic {name}={value}'
 
+def save_traces(*names):
+    ''' Only these traces are written to the .raw file, e.g. save_traces('V(out)', 'I(R1)') '''
+    return '.save ' + ' '.join(names)
+
+def spice_options(**opts):
+    '''
+    e.g. spice_options(plotwinsize=0, numdgt=7).  True gives a flag without a value.
+    plotwinsize, plotreltol, plotvntol, plotabstol control the compression of the .raw file
+    '''
+    return '.options ' + ' '.join(k if v is True else f'{k}={v}' for k,v in opts.items())
+
 ### Spice waveforms
 # TODO add some useful functions that translate into these (e.g. triangle..)
 def sine(freq, amp, offset=0, delay=0, phase=0, damping=0, ncycles=None):
@@ -531,11 +2565,8 @@ def test():
     from matplotlib import pyplot as plt
     import pandas as pd
     # Try changing all parameters by ±50%
-    datalist = []
-    for name, value in get_params(netlist).items():
-        for v in np.linspace(0.5*value, 1.5*value, 5):
-            data = runspice(netchange(netlist, param(name, v)))
-            datalist.append(data)
+    points = [{name: v} for name, value in get_params(netlist).items() for v in np.linspace(0.5*value, 1.5*value, 5)]
+    datalist = sweep(netlist, points, batch_size=len(points))
 
     plt.figure()
     for data in datalist:
@@ -0,0 +1,56 @@
+'''
+Maintenance of simulation folders from the command line
+
+python -m pyltspice rebuild-index [folder]
+python -m pyltspice prune [folder] [--max-size 20G] [--max-age 30d] [--compress-after 7d] [--shard] [--dry-run]
+'''
+import argparse
+import pyltspice
+
+def parse_size(s):
+    ''' Number of bytes from e.g. 500M, 20G '''
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    s = s.strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def parse_age(s):
+    ''' Number of seconds from e.g. 90s, 12h, 30d '''
+    units = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400, 'W': 604800}
+    s = s.strip().upper()
+    if s and s[-1] in units:
+        return float(s[:-1]) * units[s[-1]]
+    return float(s)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyltspice', description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild-index', help='Index the simulations in a folder that are missing from its cache index')
+    rebuild.add_argument('folder', nargs='?', default=None, help='Simulation folder (default: pyltspice.simfolder)')
+    rebuild.add_argument('--no-verify', action='store_true', help="Don't remove entries whose files are gone")
+
+    prune = commands.add_parser('prune', help='Delete, compress or shard the least recently used simulations in a folder')
+    prune.add_argument('folder', nargs='?', default=None, help='Simulation folder (default: pyltspice.simfolder)')
+    prune.add_argument('--max-size', type=parse_size, default=None, help='Size budget of the folder, e.g. 20G')
+    prune.add_argument('--max-age', type=parse_age, default=None, help='Delete runs not used for this long, e.g. 30d')
+    prune.add_argument('--compress-after', type=parse_age, default=None,
+                       help='Compress the .raw files of runs not used for this long, e.g. 7d')
+    prune.add_argument('--shard', action='store_true', help='Move runs into subfolders by netlist hash')
+    prune.add_argument('--dry-run', action='store_true', help="Only report what would be done")
+
+    args = parser.parse_args(argv)
+    if args.command == 'rebuild-index':
+        added, removed = pyltspice.rebuild_cache_index(args.folder, verify=not args.no_verify)
+        print(f'Added {added} and removed {removed} cache index entries')
+    elif args.command == 'prune':
+        counts = pyltspice.prune_simfolder(args.folder, max_bytes=args.max_size, max_age=args.max_age,
+                                           compress_after=args.compress_after, shard=args.shard,
+                                           dry_run=args.dry_run)
+        summary = (f'deleted {counts["deleted"]}, compressed {counts["compressed"]} and moved {counts["moved"]} runs, '
+                   f'freeing {counts["freed"] / 2**20:.1f} MB')
+        print(f'Would have {summary}' if args.dry_run else summary[0].upper() + summary[1:])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pyltspice
+from spicefiles import write_stub, count_runs
+
+
+@pytest.fixture
+def spice(tmp_path, monkeypatch):
+    '''
+    pyltspice running the stub executable, with a fresh simfolder in tmp_path
+    Yields a function that returns how many times the stub was launched
+    '''
+    stubpath, countfile = write_stub(str(tmp_path))
+    monkeypatch.setattr(pyltspice, 'verbose', False)
+    monkeypatch.setattr(pyltspice, 'spicepath', stubpath, raising=False)
+    monkeypatch.setattr(pyltspice, 'simfolder', str(tmp_path / 'sims'), raising=False)
+    pyltspice.clear_result_cache()
+    yield lambda: count_runs(countfile)
+    pyltspice.flush_access_times()
+    pyltspice.clear_result_cache()
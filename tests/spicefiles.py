@@ -0,0 +1,150 @@
+'''
+Synthetic ltspice output files, and a stub executable that writes them in place of ltspice
+'''
+import os
+import sys
+
+import numpy as np
+
+HEADER = ['Title: * test', 'Date: Thu Jan  1 00:00:00 2026', 'Plotname: {plotname}', 'Flags: {flags}',
+          'No. Variables: {numvars}', 'No. Points: {numpoints:>12}', 'Offset:   0.0000000000000000e+000',
+          'Command: Linear Technology Corporation LTspice XVII', 'Variables:']
+
+def raw_header(cols, flags, plotname, numpoints, title_pad=0):
+    header = [line.format(plotname=plotname, flags=flags, numvars=len(cols), numpoints=numpoints)
+              for line in HEADER]
+    header[0] += 'x' * title_pad
+    for i, name in enumerate(cols):
+        unit = name if name in ('time', 'frequency') else ('voltage' if name.startswith('V') else 'device_current')
+        header.append(f'\t{i}\t{name}\t{unit}')
+    return header
+
+def write_raw(path, cols, flags='real forward', plotname='Transient Analysis', encoding='utf_16_le',
+              ascii=False, truncate=0, title_pad=0):
+    '''
+    Write cols {name: array} to a .raw file, the first column is the axis.
+    Binary data is laid out by the flags (real, double, complex, fastaccess), or written as text if ascii.
+    truncate cuts that many bytes off the end
+    '''
+    names = list(cols)
+    numpoints = len(cols[names[0]])
+    header = raw_header(names, flags, plotname, numpoints, title_pad)
+    flaglist = flags.split()
+    if 'complex' in flaglist:
+        formats = [np.complex128] * len(names)
+    elif 'double' in flaglist or ascii:
+        formats = [np.float64] * len(names)
+    else:
+        formats = [np.float64] + [np.float32] * (len(names) - 1)
+    if ascii:
+        header.append('Values:')
+        lines = []
+        for i in range(numpoints):
+            for j, (name, fmt) in enumerate(zip(names, formats)):
+                v = cols[name][i]
+                v = f'{v.real:.15e},{v.imag:.15e}' if 'complex' in flaglist else f'{v:.15e}'
+                lines.append(f'{i}\t{v}' if j == 0 else f'\t{v}')
+        data = ('\n'.join(lines) + '\n').encode(encoding)
+    elif 'fastaccess' in flaglist:
+        header.append('Binary:')
+        data = b''.join(np.asarray(cols[name], fmt).tobytes() for name, fmt in zip(names, formats))
+    else:
+        header.append('Binary:')
+        a = np.zeros(numpoints, np.dtype({'names': names, 'formats': formats}))
+        for name in names:
+            a[name] = cols[name]
+        data = a.tobytes()
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode(encoding))
+        f.write(data)
+        if truncate:
+            f.truncate(f.tell() - truncate)
+
+def write_log(path, steps=(), meas=(), encoding='utf_16_le'):
+    ''' .log file with .step lines for steps [{name: value}] and the .meas lines given '''
+    lines = ['Circuit: * test', '']
+    lines += ['.step ' + ' '.join(f'{k.lower()}={v}' for k, v in step.items()) for step in steps]
+    lines += ['Direct Newton iteration for .op point succeeded.', '', *meas, '',
+              'Date: Thu Jan  1 00:00:00 2026', 'Total elapsed time: 0.007 seconds.', '',
+              'tnom = 27', 'temp = 27', 'method = modified trap', 'totiter = 2345', 'traniter = 2331',
+              'solver = Normal', 'WARNING: test warning', '']
+    with open(path, 'wb') as f:
+        f.write('\n'.join(lines).encode(encoding))
+
+STUB = '''#!{python}
+# Pretends to be ltspice: writes a transient of I(R1) = sin(1000 t) / R for the .PARAM R of the netlist,
+# with a step for each value of a ".step param NAME list ..." line (R = that value, or the table() entry),
+# and a .meas of imax = 1 / R
+import os, re, sys
+sys.path.insert(0, {testdir!r})
+import numpy as np
+from spicefiles import write_raw, write_log
+
+net = sys.argv[-1]
+with open({countfile!r}, 'a') as f:
+    f.write(net + '\\n')
+text = open(net).read()
+params = dict(re.findall(r'^\\.PARAM (\\w+)=(\\S+)', text, re.I | re.M))
+numpoints = int(os.environ.get('STUB_POINTS', '50'))
+t = np.linspace(0, 1e-2, numpoints)
+step = re.search(r'^\\.step param (\\w+) list (.*)$', text, re.I | re.M)
+if step:
+    name, values = step[1], step[2].split()
+    table = re.fullmatch(r'table\\((\\w+),(.*)\\)', params.get('R', ''))
+    if table:
+        pairs = table[2].split(',')
+        lookup = dict(zip(pairs[0::2], pairs[1::2]))
+        rs = [float(lookup[v]) for v in values]
+    else:
+        rs = [float(v) for v in values]
+    steps = [{{name: v}} for v in values]
+    flags = 'real forward stepped'
+else:
+    rs = [float(params.get('R', 1))]
+    steps = []
+    flags = 'real forward'
+cols = {{'time': np.tile(t, len(rs)), 'V(in)': np.full(len(rs) * numpoints, 5.0),
+         'I(R1)': np.concatenate([np.sin(t * 1000) / r for r in rs])}}
+base = os.path.splitext(net)[0]
+if step:
+    meas = ['Measurement: imax', '  step\\tMAX(i(r1))\\tFROM\\tTO']
+    meas += ['{{:>6}}\\t{{}}\\t0\\t0.01'.format(i + 1, 1 / r) for i, r in enumerate(rs)]
+else:
+    meas = ['imax: MAX(i(r1))={{}} FROM 0 TO 0.01'.format(1 / rs[0])]
+write_raw(base + '.raw', cols, flags=flags)
+write_log(base + '.log', steps=steps, meas=meas)
+'''
+
+COPY_STUB = '''#!{python}
+# Pretends to be ltspice by copying the same .raw and .log files next to every netlist
+import os, shutil, sys
+net = sys.argv[-1]
+with open({countfile!r}, 'a') as f:
+    f.write(net + '\\n')
+base = os.path.splitext(net)[0]
+shutil.copyfile({rawpath!r}, base + '.raw')
+shutil.copyfile({logpath!r}, base + '.log')
+'''
+
+def write_stub(folder, canned=None):
+    '''
+    Write the stub executable into folder, return (its path, path of the file that logs each run)
+    With canned=(rawpath, logpath) the stub just copies those files, which is quicker than simulating
+    '''
+    stubpath = os.path.join(folder, 'ltspice_stub')
+    countfile = os.path.join(folder, 'runs.txt')
+    if canned:
+        script = COPY_STUB.format(python=sys.executable, countfile=countfile, rawpath=canned[0], logpath=canned[1])
+    else:
+        script = STUB.format(python=sys.executable, testdir=os.path.dirname(os.path.abspath(__file__)),
+                             countfile=countfile)
+    with open(stubpath, 'w') as f:
+        f.write(script)
+    os.chmod(stubpath, 0o755)
+    return stubpath, countfile
+
+def count_runs(countfile):
+    if not os.path.isfile(countfile):
+        return 0
+    with open(countfile) as f:
+        return len(f.read().split())
@@ -0,0 +1,227 @@
+'''
+Reading .raw, .log and .net files, and writing .wav files
+'''
+import wave
+
+import chardet
+import numpy as np
+import pytest
+
+import pyltspice
+from spicefiles import raw_header, write_raw, write_log
+
+T = np.linspace(0, 1e-3, 101)
+COLS = {'time': T, 'V(out)': np.sin(T * 1e4), 'I(R1)': np.cos(T * 1e4)}
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(pyltspice, 'verbose', False)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'encoding': 'utf_8'},
+    {'flags': 'real forward double'},
+    {'flags': 'real forward fastaccess'},
+    {'ascii': True},
+])
+def test_read_raw_layouts(tmp_path, kwargs):
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, COLS, **kwargs)
+    d = pyltspice.read_raw(path)
+    assert d['No. Points'] == len(T)
+    np.testing.assert_allclose(d['time'], T, rtol=1e-14)
+    np.testing.assert_allclose(d['V(out)'], COLS['V(out)'], rtol=1e-6)
+    sub = pyltspice.read_raw(path, columns=['I(R1)'])
+    np.testing.assert_allclose(sub['I(R1)'], COLS['I(R1)'], rtol=1e-6)
+    assert 'V(out)' not in sub
+    lazy = pyltspice.read_raw(path, lazy=True)
+    assert lazy['No. Points'] == len(T)
+    np.testing.assert_array_equal(lazy['time'], d['time'])
+    np.testing.assert_array_equal(lazy['I(R1)'], d['I(R1)'])
+    chunks = list(pyltspice.iter_raw(path, ['time', 'I(R1)'], chunk_points=17))
+    np.testing.assert_allclose(np.concatenate([c['time'] for c in chunks]), T, rtol=1e-14)
+    np.testing.assert_array_equal(np.concatenate([c['I(R1)'] for c in chunks]), d['I(R1)'])
+
+@pytest.mark.parametrize('ascii', [False, True])
+def test_read_raw_complex(tmp_path, ascii):
+    f = np.logspace(1, 5, 41)
+    v = 1 / (1 + 1j * f / 1e3)
+    path = str(tmp_path / 'ac.raw')
+    write_raw(path, {'frequency': f.astype(complex), 'V(out)': v}, flags='complex forward log',
+              plotname='AC Analysis', ascii=ascii)
+    d = pyltspice.read_raw(path)
+    assert not np.iscomplexobj(d['frequency'])
+    np.testing.assert_allclose(d['frequency'], f)
+    np.testing.assert_allclose(d['V(out)'], v)
+
+def test_raw_to_fastaccess(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, COLS)
+    fast = pyltspice.raw_to_fastaccess(path, str(tmp_path / 'fast.raw'))
+    np.testing.assert_allclose(pyltspice.read_raw(fast, columns=['V(out)'])['V(out)'], COLS['V(out)'], rtol=1e-6)
+    np.testing.assert_array_equal(pyltspice.read_raw(fast, lazy=True)['time'], T)
+
+def test_compress_raw(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, COLS)
+    assert pyltspice.compress_raw(path) > 0
+    assert pyltspice.compress_raw(path) == 0
+    d = pyltspice.read_raw(path)
+    np.testing.assert_allclose(d['I(R1)'], COLS['I(R1)'], rtol=1e-6)
+    lazy = pyltspice.read_raw(path, lazy=True)
+    np.testing.assert_array_equal(lazy['time'], T)
+
+def test_read_raw_truncated(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, COLS, truncate=5)
+    with pytest.raises(ValueError, match='truncated'):
+        pyltspice.read_raw(path)
+
+@pytest.mark.parametrize('encoding', ['utf_16_le', 'utf_8'])
+def test_read_raw_header_ends_at_block(tmp_path, encoding):
+    # Make the Binary: marker end exactly at the end of the first block that is read
+    width = 2 if encoding == 'utf_16_le' else 1
+    header = '\n'.join(raw_header(list(COLS), 'real forward', 'Transient Analysis', len(T)))
+    pad = (2**16 - len((header + '\nBinary:').encode(encoding))) // width
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, COLS, encoding=encoding, title_pad=pad)
+    with open(path, 'rb') as f:
+        assert f.read(2**16).endswith('\nBinary:'.encode(encoding))
+    np.testing.assert_array_equal(pyltspice.read_raw(path)['time'], T)
+
+def test_read_raw_no_data_section(tmp_path):
+    path = tmp_path / 'a.raw'
+    path.write_bytes('Title: * test\nVariables:\n'.encode('utf_16_le'))
+    with pytest.raises(ValueError, match='No data section'):
+        pyltspice.read_raw(str(path))
+
+def test_stepped_transient(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, {'time': np.tile(T, 3), 'V(out)': np.repeat([1., 2., 3.], len(T))},
+              flags='real forward stepped')
+    steps = pyltspice.read_raw(path)
+    assert [s['step'] for s in steps] == [0, 1, 2]
+    assert [s['No. Points'] for s in steps] == [len(T)] * 3
+    assert [s['V(out)'][0] for s in steps] == [1, 2, 3]
+
+def test_stepped_downward_dc_sweep(tmp_path):
+    # .dc V1 5 0 -0.5 with two steps
+    v = np.arange(5, -0.01, -0.5)
+    path = str(tmp_path / 'a.raw')
+    write_raw(path, {'V1': np.tile(v, 2), 'I(R1)': np.tile(v, 2)}, flags='real forward stepped',
+              plotname='DC transfer characteristic')
+    steps = pyltspice.read_raw(path)
+    assert len(steps) == 2
+    assert [s['No. Points'] for s in steps] == [len(v)] * 2
+    np.testing.assert_array_equal(steps[1]['V1'], v)
+
+def test_read_log_measurements(tmp_path):
+    path = str(tmp_path / 'a.log')
+    write_log(path, meas=['vmax: MAX(v(out))=4.99998 FROM 0 TO 0.01', 'tcross: v(out)=2.5 AT 0.00123',
+                          'trise=9.9e-05 FROM 5e-06 TO 0.000105', 'Measurement "bad" FAIL\'ed',
+                          'gain: mag(v(out))=(0dB,-90°) at 1000'])
+    d = pyltspice.read_log(path)
+    m = d['measurements']
+    assert m['vmax'] == 4.99998
+    assert m['tcross'] == 0.00123
+    assert m['trise'] == 9.9e-05
+    assert np.isnan(m['bad'])
+    assert m['gain'] == pytest.approx(-1j)
+    assert d['warnings'] == ['test warning']
+    assert d['solver'] == 'Normal'
+    assert d['sim_time'] == pytest.approx(0.007)
+
+def test_read_log_step_tables(tmp_path):
+    path = str(tmp_path / 'a.log')
+    write_log(path, steps=[{'R': 1}, {'R': 2}, {'R': 3}], encoding='utf_8',
+              meas=['Measurement: vmax', '  step\tMAX(v(out))\tFROM\tTO', '     1\t4.99\t0\t0.01',
+                    '     3\t2.5\t0\t0.01', '',
+                    'Measurement: tc', '  step\tv(out)=2.5\tAT', '     1\t2.5\t0.001', '     2\t2.5\t0.002'])
+    d = pyltspice.read_log(path)
+    assert d['steps'] == [{'r': 1}, {'r': 2}, {'r': 3}]
+    np.testing.assert_array_equal(d['measurements']['vmax'], [4.99, np.nan, 2.5])
+    np.testing.assert_array_equal(d['measurements']['tc'], [0.001, 0.002, np.nan])
+
+def test_netlist_encoding_without_chardet(tmp_path, monkeypatch):
+    # utf-16 (what ltspice writes) and utf-8 are recognized without asking chardet
+    monkeypatch.setattr(chardet, 'detect', None)
+    path = tmp_path / 'a.net'
+    path.write_bytes('* test\nC1 a 0 1µ\n'.encode('utf_16_le'))
+    assert pyltspice.netlist_fromfile(str(path)) == ['* test', 'C1 a 0 1µ']
+    path = tmp_path / 'b.net'
+    path.write_bytes('* test\nC1 a 0 1µ\n'.encode('utf_8'))
+    assert pyltspice.netlist_fromfile(str(path)) == ['* test', 'C1 a 0 1µ']
+
+def test_netlist_encoding_detected_from_whole_file(tmp_path):
+    # The only non-ascii character is past the part of the file that chardet looks at
+    lines = ['* test'] + [f'R{i} a b 1k ; padding padding padding' for i in range(200)] + ['C1 a 0 1µ']
+    path = tmp_path / 'a.net'
+    path.write_bytes('\n'.join(lines).encode('cp1252'))
+    assert pyltspice.netlist_fromfile(str(path))[-1] == 'C1 a 0 1µ'
+    # and what was remembered for the folder doesn't get in the way of the next file
+    path = tmp_path / 'b.net'
+    path.write_bytes('* test\nC1 a 0 1µ\n'.encode('utf_16_le'))
+    assert pyltspice.netlist_fromfile(str(path)) == ['* test', 'C1 a 0 1µ']
+
+
+def read_wav(path):
+    ''' Return samplerate and the frames of a 16 bit .wav file as a (frames, channels) array '''
+    with wave.open(path, 'rb') as w:
+        assert w.getsampwidth() == 2
+        frames = np.frombuffer(w.readframes(w.getnframes()), '<i2')
+        return w.getframerate(), frames.reshape(-1, w.getnchannels())
+
+@pytest.mark.parametrize('samplerate', [8000, 44_100])
+def test_write_wav_frames(tmp_path, samplerate):
+    path = str(tmp_path / 'a.wav')
+    t = np.linspace(0, 0.1, 101)
+    v = np.sin(t * 100)
+    pyltspice.write_wav(t, v, path, samplerate=samplerate)
+    rate, frames = read_wav(path)
+    assert rate == samplerate
+    # Samples at 0, 1/samplerate, ... up to and including 0.1 s
+    assert frames.shape == (round(0.1 * samplerate) + 1, 1)
+    expected = np.interp(np.arange(len(frames)) / samplerate, t, v) / np.max(np.abs(v))
+    np.testing.assert_allclose(frames[:, 0] / 32767, expected, atol=1e-3)
+
+def test_write_wav_channels_interleaved(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    t = np.linspace(0, 0.01, 11)
+    pyltspice.write_wav(t, [np.full(11, 0.5), np.full(11, -0.25), t * 50], path, normalize=False)
+    frames = read_wav(path)[1]
+    assert frames.shape == (442, 3)
+    assert (frames[:, 0] == int(0.5 * 32767)).all()
+    assert (frames[:, 1] == int(-0.25 * 32767)).all()
+    np.testing.assert_array_equal(frames[:, 2], (np.arange(442) / 44_100 * 50 * 32767).astype('<i2'))
+
+@pytest.mark.parametrize('normalize, fullscale', [(True, 3), (2, 2), (False, 1)])
+def test_write_wav_normalize(tmp_path, normalize, fullscale):
+    path = str(tmp_path / 'a.wav')
+    t = np.linspace(0, 0.01, 7)
+    v = np.array([0, 0.5, -0.5, 1.5, -1.5, 3, -3])
+    pyltspice.write_wav(t, v, path, samplerate=600, normalize=normalize)
+    frames = read_wav(path)[1][:, 0]
+    # Beyond full scale is clipped
+    expected = (np.clip(v / fullscale, -1, 1) * 32767).astype('<i2')
+    np.testing.assert_array_equal(frames, expected)
+
+def test_write_wav_chunks_matches_write_wav(tmp_path):
+    t = np.linspace(0, 0.02, 1001)
+    cols = {'time': t, 'V(a)': np.sin(t * 1000), 'V(b)': np.cos(t * 3000) * 2}
+    path = str(tmp_path / 'a.wav')
+    pyltspice.write_wav(t, [cols['V(a)'], cols['V(b)']], path, normalize=2)
+    # Chunks that don't line up with the samples, including an empty one
+    edges = [0, 1, 17, 17, 400, 401, 1001]
+    chunks = [{k:v[a:b] for k,v in cols.items()} for a, b in zip(edges, edges[1:])]
+    chunked = str(tmp_path / 'b.wav')
+    pyltspice.write_wav_chunks(chunks, chunked, ['V(a)', 'V(b)'], fullscale=2)
+    np.testing.assert_array_equal(read_wav(chunked)[1], read_wav(path)[1])
+    # Straight from a .raw file
+    rawpath = str(tmp_path / 'a.raw')
+    write_raw(rawpath, cols, flags='real forward double')
+    fromraw = str(tmp_path / 'c.wav')
+    pyltspice.write_wav_chunks(pyltspice.iter_raw(rawpath, ['time', 'V(a)', 'V(b)'], chunk_points=300), fromraw,
+                               ['V(a)', 'V(b)'], fullscale=2)
+    np.testing.assert_array_equal(read_wav(fromraw)[1], read_wav(path)[1])
@@ -0,0 +1,60 @@
+'''
+Netlist editing and templates
+'''
+import pytest
+
+import pyltspice
+
+POINTS = [{'R': 1, 'C': 1e-6}, {'R': 2.5, 'C': 2e-6}, {'R': '{2*L}', 'C': 3e-6}]
+
+
+def test_netchange():
+    nl = pyltspice.netchange(pyltspice.netlist, 'R1 in N001 2k', '.PARAM X=3', '.tran 0 20m 0')
+    assert nl[2] == 'R1 in N001 2k'
+    # A new .PARAM goes after the last one, not the first
+    assert nl.index('.PARAM X=3') == nl.index('.PARAM R=1') + 1
+    assert '.tran 0 20m 0' in nl and '.tran 0 10m 0' not in nl
+    assert len(nl) == len(pyltspice.netlist) + 1
+    # Keys have to match exactly
+    nl = pyltspice.netchange(pyltspice.netlist + ['R10 a b 1'], 'R1 in N001 2k')
+    assert nl[-1] == 'R10 a b 1'
+    net = pyltspice.Netlist(pyltspice.netlist)
+    net.change(R=5)
+    assert net.lines() == pyltspice.paramchange(pyltspice.netlist, R=5)
+
+@pytest.mark.parametrize('point', POINTS)
+def test_template_matches_paramchange(point):
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R', 'C'])
+    expected = pyltspice.paramchange(pyltspice.netlist, point)
+    assert template.render(point) == expected
+    assert template.hashes([point]) == [pyltspice.hash(expected)]
+
+def test_template_defaults_and_missing():
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R', 'X'])
+    # X is not in the netlist, so it gets added like paramchange does
+    assert template.render(X=3) == pyltspice.paramchange(pyltspice.netlist, X=3)
+    with pytest.raises(KeyError):
+        template.render()
+
+def test_param_grid():
+    grid = pyltspice.param_grid(R=[1, 2], C=[1e-6, 2e-6, 3e-6])
+    assert len(grid) == 6
+    assert grid[0] == {'R': 1, 'C': 1e-6}
+    assert {(p['R'], p['C']) for p in grid} == {(r, c) for r in [1, 2] for c in [1e-6, 2e-6, 3e-6]}
+
+def test_batch_netlist_roundtrip():
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R', 'C'])
+    points = POINTS[:2]
+    assert pyltspice.can_batch(template, points)
+    assert not pyltspice.can_batch(template, POINTS)
+    batch = pyltspice.batch_netlist(template, points)
+    assert any(line.lower().startswith('.step param batchpoint') for line in batch)
+    unbatched = pyltspice.unbatch_netlist(batch)
+    assert [pyltspice.hash(nl) for nl in unbatched] == template.hashes(points)
+
+def test_select_output():
+    nl = pyltspice.select_output(pyltspice.netlist, save=['I(R1)'], options={'plotwinsize': 0})
+    assert '.save I(R1)' in nl
+    assert nl.index('.save I(R1)') < nl.index('.end')
+    assert any(line.startswith('.options') and 'plotwinsize=0' in line for line in nl)
+    assert pyltspice.select_output(pyltspice.netlist) == pyltspice.netlist
@@ -0,0 +1,349 @@
+'''
+Running netlists through a stub executable, caching, sweeps and what is done with the results
+'''
+import asyncio
+import atexit
+import os
+import shutil
+import time
+
+import numpy as np
+import pytest
+
+import pyltspice
+
+
+def peak(d):
+    return float(np.max(d['I(R1)']))
+
+def test_runspice_and_cache(spice):
+    d = pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=2))
+    assert peak(d) == pytest.approx(0.5, rel=1e-2)
+    again = pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=2))
+    assert spice() == 1
+    np.testing.assert_array_equal(again['I(R1)'], d['I(R1)'])
+    assert pyltspice.result_cache_info()['hits'] == 1
+    # Cached arrays can't be changed by accident
+    with pytest.raises(ValueError):
+        again['I(R1)'][0] = 1
+    # From the disk cache, once the in-memory one is empty
+    pyltspice.clear_result_cache()
+    cached = pyltspice.from_cache(pyltspice.paramchange(pyltspice.netlist, R=2))
+    np.testing.assert_array_equal(cached['I(R1)'], d['I(R1)'])
+    assert pyltspice.from_cache(pyltspice.paramchange(pyltspice.netlist, R=3)) is False
+
+def test_cached_result_nested_values(spice):
+    # Changing the steps or measurements of a result doesn't change what the next call gets
+    stepped = pyltspice.netlist + ['.step param R list 1 2 4']
+    d = pyltspice.runspice(stepped, measurements_only=True)
+    d['steps'][0]['R'] = 999
+    with pytest.raises(ValueError):
+        d['measurements']['imax'][0] = 999
+    again = pyltspice.runspice(stepped, measurements_only=True)
+    assert spice() == 1
+    assert again['steps'][0]['R'] == 1
+    np.testing.assert_allclose(again['measurements']['imax'], [1, 0.5, 0.25])
+
+def test_measurements(spice):
+    d = pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=2))
+    assert d['measurements'] == {'imax': 0.5}
+    assert d['warnings'] == ['test warning']
+    d = pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=4), measurements_only=True)
+    assert d['measurements']['imax'] == 0.25
+    assert 'I(R1)' not in d
+
+def test_record_timings(spice, monkeypatch):
+    monkeypatch.setattr(pyltspice, 'record_timings', True)
+    monkeypatch.setattr(pyltspice, 'stage_counters', {})
+    d = pyltspice.runspice(pyltspice.netlist)
+    rawbytes = os.path.getsize(d['filepath'])
+    assert set(d['timings']) == {'cache_lookup', 'netlist_write', 'subprocess', 'read_raw', 'read_log', 'read_net'}
+    assert d['bytes']['read_raw'] == rawbytes
+    # Cache hits get their own timings, in memory only the lookup
+    memory = pyltspice.runspice(pyltspice.netlist)
+    assert set(memory['timings']) == set(memory['bytes']) == {'cache_lookup'}
+    pyltspice.clear_result_cache()
+    disk = pyltspice.runspice(pyltspice.netlist)
+    assert set(disk['timings']) == {'cache_lookup', 'read_raw', 'read_log', 'read_net'}
+    assert disk['bytes']['read_raw'] == rawbytes
+    # The counters add up over all of them
+    counters = pyltspice.stage_counters
+    assert counters['cache_lookup']['calls'] == 3
+    assert counters['read_raw'] == {'calls': 2, 'bytes': 2 * rawbytes,
+                                    'seconds': pytest.approx(d['timings']['read_raw'] + disk['timings']['read_raw'])}
+    assert counters['subprocess']['calls'] == 1
+    pyltspice.reset_stage_counters()
+    assert counters == {}
+
+def test_event_hooks(spice, monkeypatch):
+    events = []
+    monkeypatch.setattr(pyltspice, 'event_hooks', [lambda event, fields: events.append((event, fields))])
+    d = pyltspice.runspice(pyltspice.netlist)
+    names = [event for event, fields in events]
+    assert names.index('write_netlist') < names.index('execute')
+    stages = [fields for event, fields in events if event == 'stage']
+    assert [f['stage'] for f in stages] == ['cache_lookup', 'netlist_write', 'subprocess', 'read_raw', 'read_log',
+                                            'read_net']
+    assert stages[3]['path'] == d['filepath']
+    assert stages[3]['bytes'] == os.path.getsize(d['filepath'])
+    # Timings are only put in the results if record_timings
+    assert 'timings' not in d
+    events.clear()
+    pyltspice.runspice(pyltspice.netlist)
+    assert [event for event, fields in events] == ['stage', 'memory_hit']
+
+def test_runspice_many_order_and_dedupe(spice):
+    rs = [3, 1, 2, 1, 3]
+    netlists = [pyltspice.paramchange(pyltspice.netlist, R=r) for r in rs]
+    results = pyltspice.runspice_many(netlists, workers=3)
+    assert spice() == 3
+    assert [peak(d) for d in results] == pytest.approx([1 / r for r in rs], rel=1e-2)
+    # Duplicates get their own dicts
+    assert results[1] is not results[3]
+    unordered = dict(pyltspice.runspice_many(netlists, ordered=False))
+    assert sorted(unordered) == list(range(len(rs)))
+    assert spice() == 3
+
+def test_arunspice(spice, monkeypatch):
+    monkeypatch.setattr(pyltspice, 'max_async_runs', 2)
+    netlists = [pyltspice.paramchange(pyltspice.netlist, R=r) for r in (1, 2, 4)]
+    async def run_all():
+        return await asyncio.gather(*[pyltspice.arunspice(nl) for nl in netlists])
+    results = asyncio.run(run_all())
+    assert [peak(d) for d in results] == pytest.approx([1, 0.5, 0.25], rel=1e-2)
+    assert results[0]['measurements'] == {'imax': 1}
+    # From the cache the second time
+    d = asyncio.run(pyltspice.arunspice(netlists[1]))
+    assert spice() == 3
+    np.testing.assert_array_equal(d['I(R1)'], results[1]['I(R1)'])
+
+def test_arunspice_timeout(spice, monkeypatch, tmp_path):
+    stubpath = str(tmp_path / 'hanging_stub')
+    pidfile = str(tmp_path / 'pid')
+    with open(stubpath, 'w') as f:
+        f.write(f'#!/bin/sh\necho $$ > {pidfile}\nexec sleep 30\n')
+    os.chmod(stubpath, 0o755)
+    monkeypatch.setattr(pyltspice, 'spicepath', stubpath)
+    t0 = time.time()
+    assert asyncio.run(pyltspice.arunspice(pyltspice.netlist, timeout=0.5)) == {}
+    assert time.time() - t0 < 5
+    # The process was killed, and waited for
+    with open(pidfile) as f:
+        pid = int(f.read())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+def test_rebuild_cache_index(spice):
+    for r in (1, 2, 3):
+        pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=r))
+    folder = pyltspice.simfolder
+    os.remove(os.path.join(folder, pyltspice.cache_index_name))
+    pyltspice._cache_indices.clear()
+    added, removed = pyltspice.rebuild_cache_index(folder)
+    assert (added, removed) == (0, 0)  # reopening the index indexes the folder already
+    h = pyltspice.hash(pyltspice.paramchange(pyltspice.netlist, R=2))
+    assert pyltspice.cache_index_lookup(h).endswith('.net')
+    pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=2))
+    assert spice() == 3
+
+def test_stepped_run(spice):
+    d = pyltspice.runspice(pyltspice.netlist + ['.step param R list 1 2 4'])
+    assert len(d) == 3
+    assert [s['step'] for s in d] == [0, 1, 2]
+    assert [s['R'] for s in d] == [1, 2, 4]
+    assert [peak(s) for s in d] == pytest.approx([1, 0.5, 0.25], rel=1e-2)
+
+def test_prune(spice):
+    for r in (1, 2, 3):
+        pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=r))
+    folder = pyltspice.simfolder
+    counts = pyltspice.prune_simfolder(max_bytes=0, dry_run=True)
+    assert counts['deleted'] == 3
+    assert len(os.listdir(folder)) > 1
+    counts = pyltspice.prune_simfolder(max_bytes=0)
+    assert counts['deleted'] == 3
+    assert os.listdir(folder) == [pyltspice.cache_index_name]
+    # Nothing is left in memory either
+    assert pyltspice.from_cache(pyltspice.paramchange(pyltspice.netlist, R=2)) is False
+    assert pyltspice.result_cache_info()['entries'] == 0
+
+def test_prune_past_undeletable_files(spice, monkeypatch):
+    for r in (1, 2, 3):
+        pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=r))
+    locked = pyltspice.hash(pyltspice.paramchange(pyltspice.netlist, R=2))
+    locked = os.path.splitext(pyltspice.cache_index_lookup(locked))[0] + '.raw'
+    remove = os.remove
+    def remove_unless_locked(path):
+        if os.path.abspath(path) == locked:
+            raise PermissionError('file is open in another program')
+        remove(path)
+    monkeypatch.setattr(os, 'remove', remove_unless_locked)
+    counts = pyltspice.prune_simfolder(max_bytes=0)
+    assert counts['deleted'] == 3
+    # The locked file stays, but it is out of the index, and everything else is gone
+    remaining = [name for name in os.listdir(pyltspice.simfolder) if name != pyltspice.cache_index_name]
+    assert remaining == [os.path.basename(locked)]
+    assert pyltspice.from_cache(pyltspice.paramchange(pyltspice.netlist, R=2)) is False
+
+def test_prune_compress_and_shard(spice):
+    d = pyltspice.runspice(pyltspice.netlist)
+    counts = pyltspice.prune_simfolder(compress_after=-1, shard=True)
+    assert (counts['compressed'], counts['moved']) == (1, 1)
+    # The in-memory cache doesn't hand out the old path
+    cached = pyltspice.from_cache(pyltspice.netlist)
+    assert os.path.isfile(cached['filepath'])
+    assert os.path.dirname(cached['filepath']) != os.path.dirname(d['filepath'])
+    np.testing.assert_array_equal(cached['I(R1)'], d['I(R1)'])
+
+def test_exit_flush(spice, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, 'register', registered.append)
+    monkeypatch.setattr(pyltspice, '_flush_at_exit_registered', False)
+    for r in (1, 2):
+        pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=r))
+        pyltspice.clear_result_cache()
+        pyltspice.from_cache(pyltspice.paramchange(pyltspice.netlist, R=r))
+        pyltspice.flush_access_times()
+    assert registered == [pyltspice.flush_access_times_at_exit]
+    # Pending access times of a simfolder that is gone by the time python exits
+    pyltspice.clear_result_cache()
+    pyltspice.from_cache(pyltspice.paramchange(pyltspice.netlist, R=1))
+    shutil.rmtree(pyltspice.simfolder)
+    pyltspice.flush_access_times_at_exit()
+
+def test_sweep(spice):
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R'])
+    points = pyltspice.param_grid(R=[1, 2, 4])
+    results = pyltspice.sweep(template, points, workers=2)
+    assert [peak(d) for d in results] == pytest.approx([1, 0.5, 0.25], rel=1e-2)
+    pyltspice.sweep(template, points + [{'R': 8}])
+    assert spice() == 4
+
+def test_batched_sweep(spice):
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R'])
+    points = [{'R': r} for r in (1, 2, 4, 8, 16)]
+    results = pyltspice.sweep(template, points, batch_size=2)
+    assert spice() == 3
+    assert [peak(d) for d in results] == pytest.approx([1 / p['R'] for p in points], rel=1e-2)
+    assert [d['R'] for d in results] == [1, 2, 4, 8, 16]
+    assert all('step' not in d for d in results)
+    # Every point has its own cache entry, found in memory and on disk
+    assert pyltspice.from_cache(template.render(points[3]))['R'] == 8
+    pyltspice.clear_result_cache()
+    again = pyltspice.sweep(template, points, batch_size=2)
+    assert spice() == 3
+    assert [peak(d) for d in again] == [peak(d) for d in results]
+    single = pyltspice.runspice(template.render(points[2]))
+    assert spice() == 3
+    assert peak(single) == peak(results[2])
+
+def test_batch_points_counted_once_in_memory(spice):
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R'])
+    results = pyltspice.sweep(template, [{'R': r} for r in (1, 2, 3)], batch_size=3)
+    info = pyltspice.result_cache_info()
+    assert info['entries'] == 3
+    assert info['bytes'] == sum(pyltspice.result_nbytes(d) for d in results)
+
+def test_decimate(spice, monkeypatch):
+    monkeypatch.setenv('STUB_POINTS', '200000')
+    monkeypatch.setattr(pyltspice, 'pyramid_points', 1000)
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R'])
+    # Batch points share one .raw file and pyramid, each has to get the envelope of its own step
+    results = pyltspice.sweep(template, [{'R': r} for r in (1, 2, 4)], batch_size=3)
+    assert os.path.isfile(pyltspice.pyramid_path(results[0]['filepath']))
+    for d in results:
+        out = pyltspice.decimate(d, 500)
+        assert len(out['time']) <= 500
+        assert out['I(R1)'].max() == np.max(d['I(R1)'])
+        assert out['I(R1)'].min() == np.min(d['I(R1)'])
+        window = pyltspice.decimate(d, 500, 2e-3, 3e-3)
+        inside = (d['time'] >= 2e-3) & (d['time'] <= 3e-3)
+        # The bins at the ends can reach a little outside of the window
+        assert window['time'].min() > 1.99e-3 and window['time'].max() < 3.01e-3
+        assert window['I(R1)'].max() >= d['I(R1)'][inside].max()
+        assert window['I(R1)'].min() <= d['I(R1)'][inside].min()
+    # Few enough points are returned as they are
+    d = results[0]
+    small = pyltspice.decimate(d, 500, 1e-3, 1e-3 + 1e-6)
+    inside = (d['time'] >= 1e-3) & (d['time'] <= 1e-3 + 1e-6)
+    np.testing.assert_array_equal(small['I(R1)'], d['I(R1)'][inside])
+
+def test_decimate_changed_results(spice, monkeypatch):
+    monkeypatch.setenv('STUB_POINTS', '200000')
+    monkeypatch.setattr(pyltspice, 'pyramid_points', 1000)
+    d = pyltspice.runspice(pyltspice.netlist)
+    # Renamed by a namemap, so not under that name in the stored pyramid
+    renamed = pyltspice.runspice(pyltspice.netlist, namemap={'I(R1)': 'i'})
+    out = pyltspice.decimate(renamed, 500)
+    assert out['i'].max() == np.max(d['I(R1)'])
+    # Changed arrays get the envelope of what they are now
+    changed = dict(d, **{'I(R1)': d['I(R1)'] * 2})
+    out = pyltspice.decimate(changed, 500)
+    assert out['I(R1)'].max() == 2 * np.max(d['I(R1)'])
+    # The file, and the result as it came out of runspice, still use the stored pyramid
+    monkeypatch.setattr(pyltspice, 'pyramid_levels', None)
+    for source in (d['filepath'], pyltspice.read_raw(d['filepath'], lazy=True), d):
+        out = pyltspice.decimate(source, 500)
+        assert out['I(R1)'].max() == np.max(d['I(R1)'])
+
+def test_decimate_without_pyramid_file(spice, monkeypatch):
+    monkeypatch.setenv('STUB_POINTS', '20000')
+    monkeypatch.setattr(pyltspice, 'pyramid_points', 1000)
+    def readonly(*args, **kwargs):
+        raise PermissionError('read-only folder')
+    monkeypatch.setattr(np, 'savez', readonly)
+    d = pyltspice.runspice(pyltspice.netlist)
+    assert not os.path.isfile(pyltspice.pyramid_path(d['filepath']))
+    assert not any('.tmp' in name for name in os.listdir(pyltspice.simfolder))
+    out = pyltspice.decimate(d, 500)
+    assert out['I(R1)'].max() == np.max(d['I(R1)'])
+
+def test_resample_runs(spice):
+    template = pyltspice.NetlistTemplate(pyltspice.netlist, ['R'])
+    points = [{'R': r} for r in (1, 2, 4)]
+    pyltspice.sweep(template, points)
+    out = pyltspice.resample_runs(template.hashes(points), np.linspace(0, 1.1e-2, 23))
+    assert out['I(R1)'].shape == (3, 23)
+    assert out['I(R1)'].dtype == np.float32
+    np.testing.assert_array_equal(out['params']['R'], [1, 2, 4])
+    assert np.isnan(out['I(R1)'][:, -1]).all()
+    np.testing.assert_allclose(out['I(R1)'][1, :-1] * 2, out['I(R1)'][0, :-1], atol=1e-3)
+
+def test_adaptive_sweep(spice):
+    values, metrics, results = pyltspice.adaptive_sweep(pyltspice.netlist, 'R', peak, lo=0.1, hi=10,
+                                                        budget=15, initial=5, workers=2)
+    assert len(values) == 15
+    assert spice() == 15
+    assert np.all(np.diff(values) > 0)
+    # The steep end (small R) gets more points
+    assert np.sum(values < 2.575) > np.sum(values > 7.525)
+    assert metrics == pytest.approx([peak(d) for d in results])
+
+def test_store_and_query(spice, tmp_path):
+    results = [pyltspice.runspice(pyltspice.paramchange(pyltspice.netlist, R=r)) for r in (1, 2, 4)]
+    store = str(tmp_path / 'store.zip')
+    assert pyltspice.store_results(store, results) == [0, 1, 2]
+    found = pyltspice.query_store(store, R=(1, 2))
+    assert [run['R'] for run in found] == [1, 2]
+    np.testing.assert_array_equal(found[1]['I(R1)'], results[1]['I(R1)'])
+    # .meas results are queried as meas.<name>, and come back as measurements
+    found = pyltspice.query_store(store, **{'meas.imax': (0.3, 1)})
+    assert [run['R'] for run in found] == [1, 2]
+    assert found[1]['measurements'] == {'imax': 0.5}
+    assert 'I(R1)' not in pyltspice.query_store(store, columns=[], R=4)[0]
+    # Appending adds runs after the ones already stored
+    assert pyltspice.store_results(store, results[:1]) == [3]
+    assert [run['run'] for run in pyltspice.query_store(store, columns=[], R=1)] == [0, 3]
+    assert pyltspice.store_results(store, [{'R': 5, 'measurements': {'gain': 1 - 1j}}]) == [4]
+    assert pyltspice.query_store(store, R=5)[0]['measurements'] == {'gain': 1 - 1j}
+
+def test_store_empty_appends_and_odd_values(tmp_path):
+    store = str(tmp_path / 'store.zip')
+    assert pyltspice.store_results(store, []) == []
+    assert not os.path.exists(store)
+    assert pyltspice.store_results(store, [{'R': 1}, {'R': '{2*L}'}]) == [0, 1]
+    assert pyltspice.store_results(store, [{}, {}]) == []
+    assert pyltspice.store_results(store, [{'R': 3}]) == [2]
+    assert [run['run'] for run in pyltspice.query_store(store)] == [0, 1, 2]
+    # Runs whose value can't be compared with the range just don't match
+    assert [run['R'] for run in pyltspice.query_store(store, R=(1, 3))] == [1, 3]